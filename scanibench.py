@@ -0,0 +1,223 @@
+"""
+# Benchmarks of the acquisition path
+
+Runs the acquisition code against a simulated DSA (`scanisim`) over the
+loopback interface. The simulator runs in its own process and sends frames
+as fast as possible, so the numbers are the limits of the client:
+
+ * `scan`: frames/s and bytes/s sustained by `Packet.scan`, CPU use of the
+   acquisition process and peak RSS, for each model/packet size, number of
+   frames (FPS) and receive buffer size (`Packet.chunksize`).
+ * `decode`: cost of `Packet.get_pressure` in ns/frame.
+ * `command`: round trip of `list_any` and of a `set_vars` transaction.
+
+The results are written as JSON. Two result files can be compared to spot
+regressions between releases:
+
+```
+python scanibench.py -o new.json
+python scanibench.py --compare old.json new.json
+```
+"""
+import json
+import multiprocessing
+import platform
+import sys
+import time
+
+import numpy as np
+
+import scanivalve
+import scanisim
+
+# (model, tinfo): packets of 104, 104 and 112 bytes
+PACKETS = [('3017', False), ('3217', False), ('3217', True)]
+
+
+def run_simulator(conn, model):
+    "Simulator process: sends its port and serves until the pipe is closed"
+    sim = scanisim.Simulator(model, rate=0)
+    conn.send(sim.port)
+    try:
+        conn.recv()
+    except EOFError:
+        pass
+    sim.close()
+
+
+class SimulatorProcess(object):
+    "Simulator running in a separate process"
+    def __init__(self, model):
+        self.conn, child = multiprocessing.Pipe()
+        self.proc = multiprocessing.Process(target=run_simulator, args=(child, model), daemon=True)
+        self.proc.start()
+        self.port = self.conn.recv()
+
+    def close(self):
+        self.conn.send(None)
+        self.proc.join(5)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def peak_rss():
+    "Peak resident memory of this process in MB (`None` where it is not available, e.g. Windows)"
+    try:
+        import resource
+    except ImportError:
+        return None
+    r = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return r / 1024**2 if sys.platform == 'darwin' else r / 1024
+
+
+def bench_scan(s, fps, chunksize, repeat=3):
+    "Best of `repeat` finite acquisitions of `fps` frames"
+    s.config(FPS=fps)
+    s.pack.chunksize = chunksize
+    best = None
+    for i in range(repeat):
+        c0 = time.process_time()
+        t0 = time.perf_counter()
+        s.start()
+        s.thread.join()
+        t1 = time.perf_counter()
+        c1 = time.process_time()
+        n = s.pack.samplesread
+        s.read(dtype=np.float32, copy=False)
+        wall = t1 - t0
+        if best is None or wall < best['wall']:
+            best = dict(frames=n, wall=wall, cpu=100 * (c1 - c0) / wall)
+    packlen = s.pack.packlen
+    return dict(kind='scan', model=s.model, packlen=packlen, fps=fps, chunksize=chunksize,
+                frames_per_s=best['frames'] / best['wall'],
+                bytes_per_s=best['frames'] * packlen / best['wall'],
+                cpu_percent=best['cpu'], wall=best['wall'], peak_rss_mb=peak_rss())
+
+
+def bench_decode(pack, nframes=1000000, repeat=5):
+    "Decoding cost of `Packet.get_pressure` (copy to float64 and float32 view)"
+    pack.clear()
+    pack.allocbuffer(nframes)
+    pack.samplesread = nframes
+    pack.dataread = True
+    res = []
+    for dtype, copy in [(np.float64, True), (np.float32, True), (np.float32, False)]:
+        best = np.inf
+        for i in range(repeat):
+            t0 = time.perf_counter()
+            pack.get_pressure(dtype, copy)
+            best = min(best, time.perf_counter() - t0)
+        res.append(dict(kind='decode', model=pack.model, packlen=pack.packlen,
+                        dtype=np.dtype(dtype).name, copy=copy,
+                        ns_per_frame=1e9 * best / nframes))
+    pack.clear()
+    return res
+
+
+def bench_command(s, repeat=200):
+    "Median round trip of LIST S and of a SET + LIST S transaction in μs"
+    tl = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        s.list_any('S')
+        tl.append(time.perf_counter() - t0)
+    ts = []
+    for i in range(repeat):
+        t0 = time.perf_counter()
+        s.set_vars([('AVG', 16 + i % 2)])
+        ts.append(time.perf_counter() - t0)
+    return [dict(kind='command', model=s.model, command='LIST S', us=1e6 * np.median(tl)),
+            dict(kind='command', model=s.model, command='SET', us=1e6 * np.median(ts))]
+
+
+def run(fps=(10000, 100000, 1000000), chunks=(4096, 65536, 1048576), packets=PACKETS,
+        repeat=3, verbose=True):
+    "Runs every benchmark. Returns a dictionary ready to be saved as JSON"
+    results = []
+    for model, tinfo in packets:
+        with SimulatorProcess(model) as sim:
+            s = scanivalve.Scanivalve('127.0.0.1', tinfo, sim.port)
+            try:
+                s.config(PERIOD=160, AVG=1)
+                if not tinfo:
+                    results.extend(bench_command(s))
+                for n in fps:
+                    for cs in chunks:
+                        r = bench_scan(s, n, cs, repeat)
+                        results.append(r)
+                        if verbose:
+                            print("scan {} {}B FPS={} chunk={}: {:.0f} frames/s, {:.1f} MB/s, CPU {:.0f}%".format(
+                                model, r['packlen'], n, cs, r['frames_per_s'],
+                                r['bytes_per_s']/1e6, r['cpu_percent']))
+                results.extend(bench_decode(s.pack))
+                s.config(FPS=1)
+            finally:
+                s.close()
+    if verbose:
+        for r in results:
+            if r['kind'] == 'decode':
+                print("decode {}B {} copy={}: {:.2f} ns/frame".format(r['packlen'], r['dtype'],
+                                                                      r['copy'], r['ns_per_frame']))
+            elif r['kind'] == 'command':
+                print("command {} {}: {:.0f} μs".format(r['model'], r['command'], r['us']))
+    return dict(time=time.strftime('%Y-%m-%dT%H:%M:%S'), python=platform.python_version(),
+                numpy=np.__version__, platform=platform.platform(),
+                peak_rss_mb=peak_rss(), results=results)
+
+
+def key(r):
+    "Identifies a benchmark case in a result file"
+    return tuple((k, r[k]) for k in ('kind', 'model', 'packlen', 'fps', 'chunksize',
+                                     'dtype', 'copy', 'command') if k in r)
+
+
+# Figure of merit of each kind of benchmark and whether larger is better
+MERIT = dict(scan=('frames_per_s', True), decode=('ns_per_frame', False), command=('us', False))
+
+
+def compare(old, new, tol=0.1):
+    """
+    Compares two result files (dictionaries returned by `run`). Returns a
+    list of `(case, old, new, ratio)` where `ratio` > 1 is an improvement.
+    Cases worse than `tol` are printed.
+    """
+    prev = {key(r): r for r in old['results']}
+    out = []
+    for r in new['results']:
+        k = key(r)
+        if k not in prev:
+            continue
+        field, larger = MERIT[r['kind']]
+        a, b = prev[k][field], r[field]
+        ratio = b / a if larger else a / b
+        out.append((dict(k), a, b, ratio))
+        if ratio < 1 - tol:
+            print("REGRESSION {}: {} {:.4g} -> {:.4g}".format(dict(k), field, a, b))
+    return out
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Scanivalve acquisition benchmarks')
+    parser.add_argument('-o', '--output', default='scanibench.json', help='JSON result file')
+    parser.add_argument('--fps', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--chunks', type=int, nargs='+', default=[4096, 65536, 1048576])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead of running')
+    args = parser.parse_args()
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        for k, a, b, ratio in compare(old, new):
+            print("{}: {:.4g} -> {:.4g} ({:.2f}x)".format(k, a, b, ratio))
+    else:
+        res = run(args.fps, args.chunks, repeat=args.repeat)
+        with open(args.output, 'w') as f:
+            json.dump(res, f, indent=1)
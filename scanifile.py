@@ -0,0 +1,245 @@
+"""
+# Scanivalve capture files
+
+Compact binary format for raw scanivalve frames:
+
+ * Header: magic `SCANICAP`, format version (uint32), length of the metadata
+   (uint32) and the metadata as JSON (model, packet layout, FPS, AVG,
+   PERIOD, XSCANTRIG and the `list_config` snapshot).
+ * Chunks: magic `CHNK`, number of frames (uint32), index of the first
+   frame (uint64) followed by the raw frames, exactly as sent by the scanivalve.
+ * Block index: magic `INDX`, a reserved uint32, number of chunks (uint64) and, for each chunk,
+   the file offset of its frames, the first frame and the number of frames
+   (3 uint64).
+ * Footer: offset of the block index (uint64) and magic `SCANIEND`.
+
+The frames are never decoded when writing. When reading, only the chunks
+overlapping the requested window are touched. If the file was not closed
+(crash), the block index is rebuilt by walking the chunk headers.
+
+```python
+import scanivalve, scanifile
+
+s = scanivalve.Scanivalve(ip)
+s.config(FPS=10000)
+s.start()
+scanifile.save_capture('run.scap', s)
+p, freq = s.read()
+
+f = scanifile.CaptureReader('run.scap')
+p = f.read_time(1.0, 2.0, chans=[0, 3, 5])
+```
+"""
+import json
+import struct
+import time
+
+import numpy as np
+
+import scanivalve
+
+MAGIC = b'SCANICAP'
+VERSION = 1
+CHUNK = b'CHNK'
+INDEX = b'INDX'
+END = b'SCANIEND'
+
+header_fmt = struct.Struct('<8sII')
+chunk_fmt = struct.Struct('<4sIQ')
+footer_fmt = struct.Struct('<Q8s')
+
+
+class CaptureWriter(object):
+    """
+    Writes raw frames into a capture file.
+
+    `info` is the metadata of the acquisition, usually
+    `Scanivalve.capture_info()`. It must have at least `model`, `packlen`
+    and `t` (time information in the frames).
+    """
+    def __init__(self, filename, info):
+        self.filename = filename
+        self.info = dict(info)
+        self.packlen = info['packlen']
+        self.nframes = 0
+        self.index = []
+        self.f = open(filename, 'wb')
+        meta = json.dumps(self.info).encode()
+        self.f.write(header_fmt.pack(MAGIC, VERSION, len(meta)))
+        self.f.write(meta)
+        self.pos = header_fmt.size + len(meta)
+
+    def write(self, frames):
+        """
+        Appends a block of raw frames (array with shape `(n, packlen)` or
+        bytes) as a new chunk.
+        """
+        if len(frames) == 0:
+            return
+        data = memoryview(np.ascontiguousarray(frames)).cast('B')
+        n = len(data) // self.packlen
+        if n * self.packlen != len(data):
+            raise RuntimeError("Incomplete frame in capture data!")
+        self.f.write(chunk_fmt.pack(CHUNK, n, self.nframes))
+        self.f.write(data)
+        self.pos += chunk_fmt.size
+        self.index.append((self.pos, self.nframes, n))
+        self.pos += len(data)
+        self.nframes += n
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        "Writes the block index and closes the file"
+        if self.f is None:
+            return
+        self.f.write(chunk_fmt.pack(INDEX, 0, len(self.index)))
+        self.f.write(np.array(self.index, np.uint64).reshape(-1, 3).tobytes())
+        self.f.write(footer_fmt.pack(self.pos, END))
+        self.f.close()
+        self.f = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def save_capture(filename, scani):
+    """
+    Saves the frames of an acquisition started with `scani.start()` into a
+    capture file. Waits for the end of the acquisition. Should be called
+    before `scani.read()`, which releases the frames.
+    """
+    pack = scani.pack
+    if pack.ring:
+        raise RuntimeError("save_capture needs a finite acquisition with stored frames. Use record_capture!")
+    if scani.thread is not None:
+        scani.thread.join()
+        # The device is idle again: the configuration can be listed
+        scani.acquiring = False
+    if pack.samplesread == 0:
+        raise RuntimeError("Nothing to save from scanivalve!")
+    with CaptureWriter(filename, scani.capture_info()) as w:
+        w.write(pack.buf[:pack.samplesread])
+
+
+def record_capture(filename, scani, duration, interval=0.1):
+    """
+    Continuous acquisition (FPS=0) of `duration` seconds streamed to a
+    capture file. Frames are moved from the ring buffer to the file every
+    `interval` seconds. Returns the number of frames written.
+    """
+    if scani.FPS != 0:
+        raise RuntimeError("record_capture needs a continuous acquisition (FPS=0)!")
+    with CaptureWriter(filename, scani.capture_info()) as w:
+        scani.start()
+        t1 = time.monotonic() + duration
+        try:
+            while time.monotonic() < t1:
+                time.sleep(interval)
+                w.write(scani.pack.drain_raw())
+        finally:
+            scani.stop()
+            w.write(scani.pack.drain_raw())
+        return w.nframes
+
+
+class CaptureReader(object):
+    """
+    Random access to a capture file.
+
+    The file is memory mapped: `read` only loads the chunks that overlap the
+    requested frames and only the requested channels are decoded.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            magic, version, nmeta = header_fmt.unpack(f.read(header_fmt.size))
+            if magic != MAGIC:
+                raise RuntimeError("{} is not a scanivalve capture file!".format(filename))
+            if version > VERSION:
+                raise RuntimeError("Capture file version {} not supported!".format(version))
+            self.info = json.loads(f.read(nmeta).decode())
+        self.start = header_fmt.size + nmeta
+        self.packlen = self.info['packlen']
+        self.dtype = scanivalve.frame_dtype(self.info['t'])
+        self.data = np.memmap(filename, np.uint8, 'r')
+        self.index = self.read_index()
+        if len(self.index) > 0:
+            self.nframes = int(self.index[-1,1] + self.index[-1,2])
+        else:
+            self.nframes = 0
+        self.dt = self.info.get('dt')
+
+    def read_index(self):
+        "Reads the block index, rebuilding it if the file was not closed"
+        data = self.data
+        nb = len(data)
+        if nb >= self.start + footer_fmt.size:
+            pos, end = footer_fmt.unpack(data[nb-footer_fmt.size:].tobytes())
+            if end == END:
+                magic, zero, nchunks = chunk_fmt.unpack(data[pos:pos+chunk_fmt.size].tobytes())
+                p = pos + chunk_fmt.size
+                return np.frombuffer(data[p:p+24*nchunks].tobytes(), np.uint64).reshape(-1, 3).astype(np.int64)
+        index = []
+        pos = self.start
+        while pos + chunk_fmt.size <= nb:
+            magic, n, first = chunk_fmt.unpack(data[pos:pos+chunk_fmt.size].tobytes())
+            if magic != CHUNK:
+                break
+            pos += chunk_fmt.size
+            n = min(n, (nb - pos) // self.packlen) # Last chunk might be truncated
+            index.append((pos, first, n))
+            pos += n * self.packlen
+        return np.array(index, np.int64).reshape(-1, 3)
+
+    def __len__(self):
+        return self.nframes
+
+    def frames(self, start=0, stop=None):
+        """
+        Structured array with the raw frames `start` to `stop`.
+        A view into the file if the frames are in a single chunk.
+        """
+        stop = self.nframes if stop is None else min(stop, self.nframes)
+        start = max(0, start)
+        if stop <= start:
+            return np.zeros(0, self.dtype)
+        idx = self.index
+        c0 = np.searchsorted(idx[:,1], start, 'right') - 1
+        c1 = np.searchsorted(idx[:,1], stop, 'left')
+        pieces = []
+        for off, first, n in idx[c0:c1]:
+            k0 = max(start, first) - first
+            k1 = min(stop, first + n) - first
+            raw = self.data[off + k0*self.packlen:off + k1*self.packlen]
+            pieces.append(raw.view(self.dtype))
+        return pieces[0] if len(pieces) == 1 else np.concatenate(pieces)
+
+    def read(self, start=0, stop=None, chans=None, field='press', dtype=np.float64):
+        """
+        Decodes frames `start` to `stop` of `field` ('press' or 'temp')
+        for the channels `chans` (indexes starting at 0, all by default).
+        """
+        x = self.frames(start, stop)[field]
+        if chans is not None:
+            x = x[:, chans]
+        return x.astype(dtype)
+
+    def read_time(self, t0=0.0, t1=None, chans=None, field='press', dtype=np.float64):
+        "Same as `read` but the window is given in seconds from the start of the acquisition"
+        start = int(np.ceil(t0 / self.dt))
+        stop = None if t1 is None else int(np.ceil(t1 / self.dt))
+        return self.read(start, stop, chans, field, dtype)
+
+    def close(self):
+        self.data = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -346,14 +346,15 @@ class ScaniConfig(QWidget):
                 v.setEnabled(False)
             
             self.scani.hard_zero()
+            # Busy indicator until the scanivalve is done
+            self.progress.setMaximum(0)
             tstart = time.monotonic()
-            tint = 8.0
-            while True:
-                mysleep(0.5)
-                dt = time.monotonic() - tstart
-                self.progress.setValue(dt/tint * 100)
-                if dt > tint:
+            tmax = 30.0
+            while self.scani.zeroing():
+                mysleep(0.2)
+                if time.monotonic() - tstart > tmax:
                     break
+            self.progress.setMaximum(100)
                 
             self.ipg.setEnabled(True)
             self.confg.setEnabled(True)
@@ -385,12 +386,16 @@ class ScaniConfig(QWidget):
                 v.setEnabled(False)
         err = False
         self.op_buts['stop'].setEnabled(True)
+        statsonly = self.scani.statsonly
         try:
                 
             ntot = self.scani.FPS
             self.scani.stop()
             self.scani.clear()
             self.scani.pack.clear()
+            # Only the mean is shown: the frames don't need to be stored
+            if not statsonly:
+                self.scani.config(STATSONLY=True)
             self.scani.start()
             
             while True:
@@ -403,14 +408,14 @@ class ScaniConfig(QWidget):
                 if ns > (ntot-2):
                     break
 
-            p,f = self.scani.read()
+            st,f = self.scani.read_stats()
             self.progress.setValue(100)
 
-            pm = p.mean(0)
+            pm = st.mean
             pshow = ['Canal {}:     {:.1f}\n'.format(i+1, pm[i]) for i in range(16)]
             
             QMessageBox.information(self, 'Pressão média',
-                                    'Foram lidas {} amostras\n'.format(p.shape[0]) + ''.join(pshow),
+                                    'Foram lidas {} amostras\n'.format(st.n) + ''.join(pshow),
                                     QMessageBox.Ok)
             
 
@@ -419,6 +424,15 @@ class ScaniConfig(QWidget):
                                  'Erro na aquisição da pressão!', 
                                  QMessageBox.Ok)
             err = True
+        finally:
+            # Back to the previous mode. Reallocating the buffer would truncate
+            # a MEMMAP file, so it is only done if the mode was changed
+            if not statsonly and self.scani.statsonly:
+                try:
+                    self.scani.stop()
+                    self.scani.config(STATSONLY=False)
+                except:
+                    err = True
         
         self.progress.setVisible(False)
         self.ipg.setEnabled(True)
@@ -437,7 +451,6 @@ class ScaniConfig(QWidget):
         try:
             self.scani.stop()
             self.scani.clear()
-            mysleep(1.0)
             return True
         except:
             QMessageBox.critical(self, 'Erro',
@@ -0,0 +1,268 @@
+"""
+# Parallel post-processing of scanivalve acquisitions
+
+The raw frames of a finished acquisition are copied once into a
+`multiprocessing.shared_memory` block and the frame buffer of the
+`Scanivalve` object is released right away, so the next `start()` can be
+issued while the data is still being processed.
+
+A pool of worker processes attaches to the shared block (nothing is
+pickled but the block name, the work limits and the calibration of the
+channels) and computes, for groups of channels and time segments, with the
+calibration of the `Scanivalve` object applied:
+
+ * Channel statistics (number of samples, mean, standard deviation, RMS,
+   minimum and maximum), merged with `scanivalve.ChannelStats`.
+ * Power spectral density of each channel (Welch's method: Hann window,
+   `nperseg` frames per segment, mean removed from each segment).
+
+```python
+import scanivalve, scaniproc
+
+s = scanivalve.Scanivalve(ip)
+s.config(FPS=1000000)
+with scaniproc.PostProcessor() as pp:
+    s.start()
+    job = pp.submit(s)  # Waits for the end of the acquisition
+    s.start()           # Next test point
+    stats, f, psd = job.result()
+```
+
+Needs python 3.8 or later (`multiprocessing.shared_memory`).
+"""
+import math
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import scanishm
+import scanivalve
+
+
+def welch_sum(x, nperseg, step, win, nseg, batch=64):
+    "Sum of the periodograms of `nseg` windowed segments of `x` (one column per channel)"
+    nf = nperseg // 2 + 1
+    acc = np.zeros((nf, x.shape[1]))
+    if nseg <= 0:
+        return acc
+    segs = np.lib.stride_tricks.sliding_window_view(x, nperseg, axis=0)[:(nseg-1)*step+1:step]
+    for i in range(0, nseg, batch):
+        y = segs[i:i+batch]
+        y = (y - y.mean(2, keepdims=True)) * win
+        X = np.fft.rfft(y, axis=2)
+        acc += (X.real**2 + X.imag**2).sum(0).T
+    return acc
+
+
+def pressure(frames, k0, k1, c0, c1, cal):
+    "Pressure of frames `k0` to `k1`, channels `c0` to `c1`, with the calibration `cal` applied"
+    p = frames['press'][k0:k1, c0:c1]
+    if cal is None:
+        return p.astype(np.float64)
+    return cal.apply(p, np.empty(p.shape))
+
+
+def process_block(name, nframes, tinfo, c0, c1, k0, k1, s0, s1, nperseg, step, cal=None):
+    """
+    Work done by each process: statistics of frames `k0` to `k1` and the
+    periodograms of segments `s0` to `s1` for channels `c0` to `c1`.
+
+    `cal` is the calibration of the channels (`scanivalve.Calibration.to_dict`)
+    or `None`.
+    """
+    if cal is not None:
+        cal = scanivalve.Calibration.from_dict(cal)
+    # The workers share the resource tracker of the process that created the block
+    shm = scanishm.attach(name, untrack=False)
+    try:
+        frames = np.ndarray((nframes,), scanivalve.frame_dtype(tinfo), buffer=shm.buf)
+        x = pressure(frames, k0, k1, c0, c1, cal)
+        n = x.shape[0]
+        mean = x.mean(0)
+        m2 = ((x - mean)**2).sum(0)
+        xmin = x.min(0)
+        xmax = x.max(0)
+        del x
+        win = np.hanning(nperseg + 2)[1:-1] if nperseg > 1 else np.ones(1)
+        p0 = s0 * step
+        p1 = (s1 - 1) * step + nperseg
+        y = pressure(frames, p0, p1, c0, c1, cal) if s1 > s0 else None
+        psum = welch_sum(y, nperseg, step, win, s1 - s0) if y is not None else None
+        del frames, y
+    finally:
+        shm.close()
+    return (n, mean, m2, xmin, xmax), psum
+
+
+def chan_calibration(cal, c0, c1):
+    "Calibration of channels `c0` to `c1` as a dictionary (`Calibration.to_dict`)"
+    d = cal.to_dict()
+    d['offset'] = d['offset'][c0:c1]
+    d['gain'] = d['gain'][c0:c1]
+    if d['poly'] is not None:
+        d['poly'] = [c[c0:c1] for c in d['poly']]
+    d['nchans'] = c1 - c0
+    return d
+
+
+class Job(object):
+    """
+    Processing of one acquisition. `result()` waits for the workers and
+    returns the channel statistics (`scanivalve.ChannelStats`), the
+    frequencies and the PSD with shape `(nfreqs, nchans)`.
+    """
+    def __init__(self, shm, futures, rate, nperseg, nseg, nchans, groups):
+        self.shm = shm
+        self.futures = futures
+        self.rate = rate
+        self.nperseg = nperseg
+        self.nseg = nseg
+        self.nchans = nchans
+        self.groups = groups
+        self.res = None
+
+    def done(self):
+        return all(f.done() for f in self.futures)
+
+    def result(self):
+        if self.res is not None:
+            return self.res
+        try:
+            parts = [f.result() for f in self.futures]
+        finally:
+            self.release()
+        psum = np.zeros((self.nperseg // 2 + 1, self.nchans))
+        for (c0, c1), (st, ps) in zip(self.groups, parts):
+            if ps is not None:
+                psum[:, c0:c1] += ps
+        self.res = (self.merge_stats(parts), np.fft.rfftfreq(self.nperseg, 1.0/self.rate),
+                    self.scale_psd(psum))
+        return self.res
+
+    def merge_stats(self, parts):
+        "Merges the statistics of every time segment, for each group of channels"
+        stats = scanivalve.ChannelStats(self.nchans)
+        for c0, c1 in sorted(set(self.groups)):
+            gs = scanivalve.ChannelStats(c1 - c0)
+            for g, (st, ps) in zip(self.groups, parts):
+                if g == (c0, c1) and st[0] > 0:
+                    gs.combine(*st)
+            stats.mean[c0:c1] = gs.mean
+            stats.m2[c0:c1] = gs.m2
+            stats.min[c0:c1] = gs.min
+            stats.max[c0:c1] = gs.max
+            stats.n = gs.n
+        return stats
+
+    def scale_psd(self, psum):
+        "One-sided power spectral density from the sum of the periodograms"
+        if self.nseg == 0:
+            return psum
+        win = np.hanning(self.nperseg + 2)[1:-1] if self.nperseg > 1 else np.ones(1)
+        psd = psum / (self.nseg * self.rate * (win**2).sum())
+        if self.nperseg % 2 == 0:
+            psd[1:-1] *= 2
+        else:
+            psd[1:] *= 2
+        return psd
+
+    def release(self):
+        "Frees the shared memory block"
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class PostProcessor(object):
+    """
+    Process pool for the post-processing of acquisitions.
+
+    * `nworkers`: number of processes (`os.cpu_count()` by default)
+    * `nperseg`: frames per PSD segment
+    * `noverlap`: overlap of the PSD segments (`nperseg//2` by default)
+    * `chanblock`: channels per task
+    * `segframes`: approximate number of frames per task
+    """
+    def __init__(self, nworkers=None, nperseg=1024, noverlap=None, chanblock=4, segframes=262144):
+        self.pool = ProcessPoolExecutor(nworkers)
+        self.nperseg = nperseg
+        self.noverlap = nperseg // 2 if noverlap is None else noverlap
+        if self.noverlap >= nperseg:
+            raise RuntimeError("noverlap should be smaller than nperseg!")
+        self.chanblock = chanblock
+        self.segframes = segframes
+
+    def submit(self, scani):
+        """
+        Waits for the end of the acquisition of `scani` (a `Scanivalve`
+        started with `start()`) and sends its frames to the workers. The
+        frames are released: `scani` is ready for the next acquisition.
+        The calibration of `scani` (`Scanivalve.set_calibration`) is applied.
+        """
+        pack = scani.pack
+        if pack.continuous:
+            raise RuntimeError("Post-processing needs a finite acquisition (FPS > 0)!")
+        if scani.thread is not None:
+            scani.thread.join()
+        if pack.samplesread == 0:
+            raise RuntimeError("Nothing to process from scanivalve!")
+        rate = 1.0 / pack.get_time(True)
+        job = self.submit_frames(pack.buf[:pack.samplesread], rate, pack.t, pack.cal)
+        pack.clear()
+        scani.thread = None
+        scani.acquiring = False
+        return job
+
+    def submit_frames(self, raw, rate, tinfo, cal=None):
+        """
+        Sends raw frames (array with shape `(nframes, packlen)` or
+        structured array with `scanivalve.frame_dtype(tinfo)`) sampled at
+        `rate` to the workers. The calibration `cal` (`scanivalve.Calibration`),
+        if given, is applied by the workers. Returns a `Job`.
+        """
+        raw = memoryview(np.ascontiguousarray(raw)).cast('B')
+        dtype = scanivalve.frame_dtype(tinfo)
+        nframes = len(raw) // dtype.itemsize
+        if nframes == 0:
+            raise RuntimeError("No frames to process!")
+        shm = shared_memory.SharedMemory(create=True, size=len(raw))
+        shm.buf[:len(raw)] = raw
+        nchans = dtype['press'].shape[0]
+
+        nperseg = min(self.nperseg, nframes)
+        step = max(1, nperseg - min(self.noverlap, nperseg - 1))
+        nseg = (nframes - nperseg) // step + 1
+        # Tasks hold a whole number of PSD segments
+        segtask = max(1, self.segframes // step)
+        ntasks = math.ceil(nseg / segtask)
+        futures = []
+        groups = []
+        try:
+            for c0 in range(0, nchans, self.chanblock):
+                c1 = min(nchans, c0 + self.chanblock)
+                ccal = None if cal is None else chan_calibration(cal, c0, c1)
+                for i in range(ntasks):
+                    s0 = i * segtask
+                    s1 = min(nseg, s0 + segtask)
+                    k0 = s0 * step
+                    k1 = nframes if i == ntasks-1 else s1 * step
+                    futures.append(self.pool.submit(process_block, shm.name, nframes, tinfo,
+                                                    c0, c1, k0, k1, s0, s1, nperseg, step, ccal))
+                    groups.append((c0, c1))
+        except:
+            shm.close()
+            shm.unlink()
+            raise
+        return Job(shm, futures, rate, nperseg, nseg, nchans, groups)
+
+    def close(self):
+        self.pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
@@ -0,0 +1,259 @@
+"""
+# Sharing the scanivalve stream between processes
+
+`Publisher` writes the pressure of every frame received by a `Scanivalve`
+into a `multiprocessing.shared_memory` ring buffer. Any number of
+processes (logger, live plot, control loop) can attach a `Subscriber` to
+the block by name and read the frames without touching the socket.
+
+Layout of the shared block:
+
+ * Header: magic `SCANISHM`, version, number of channels, number of slots
+   in the ring, length of the metadata (uint32 each) and the frame rate
+   (float64).
+ * Write index (uint64): total number of frames written. Frame `k` is in
+   slot `k % nslots`.
+ * Generation (uint64): incremented at the start of every acquisition.
+ * Metadata: JSON (model, channel names, rate) in a fixed size area.
+ * Ring: float32 pressures with shape `(nslots, nchans)`.
+
+The producer never waits for the consumers: a subscriber that falls
+behind more than `nslots` frames loses the oldest frames and is told how
+many were lost.
+
+```python
+# Acquisition process
+import scanivalve, scanishm
+s = scanivalve.Scanivalve(ip)
+s.config(FPS=0, STATSONLY=True) # The frames are not kept in this process
+pub = scanishm.Publisher(s, 'scani1')
+s.start()
+
+# Any other process
+import scanishm
+sub = scanishm.Subscriber('scani1')
+while True:
+    views, lost = sub.poll()
+    for p in views:  # Zero copy views into the ring
+        ...
+```
+
+Needs python 3.8 or later (`multiprocessing.shared_memory`).
+"""
+import json
+import struct
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+MAGIC = b'SCANISHM'
+VERSION = 1
+
+header_fmt = struct.Struct('<8sIIIId')
+WIDX = header_fmt.size
+GENERATION = WIDX + 8
+META = GENERATION + 8
+METASIZE = 4096
+DATA = META + METASIZE
+
+# Blocks created by this process
+owned = set()
+
+
+def attach(name, untrack=True):
+    """
+    Attaches to the existing shared memory block `name` without taking
+    ownership of it: the block is not removed when this process exits.
+
+    Before python 3.13 the block is registered with the resource tracker
+    again. With `untrack` it is unregistered, which is not wanted when the
+    tracker is shared with the process that created the block (workers of
+    a process pool).
+    """
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name)
+        if untrack and shm.name not in owned:
+            resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+
+class Publisher(object):
+    """
+    Publishes the frames received by `scani` (a `Scanivalve`) into the
+    shared memory block `name` (a random name if `None`) with a ring of
+    `nslots` frames.
+
+    The publisher is a pipeline stage of the frame buffer (see
+    `Scanivalve.add_stage`): the frames are written by the receive thread
+    as they arrive. In continuous mode, frames that do not fit into the
+    ring of the `Scanivalve` are not published: either drain it or use
+    `STATSONLY=True` if the frames are not needed in this process.
+    """
+    def __init__(self, scani, name=None, nslots=65536):
+        self.scani = scani
+        self.nslots = nslots
+        self.nchans = scani.nchans()
+        self.n = 1
+        size = DATA + 4 * nslots * self.nchans
+        self.shm = shared_memory.SharedMemory(name, create=True, size=size)
+        owned.add(self.shm.name)
+        self.name = self.shm.name
+        buf = self.shm.buf
+        self.counters = np.ndarray((2,), np.uint64, buffer=buf, offset=WIDX)
+        self.ring = np.ndarray((nslots, self.nchans), np.float32, buffer=buf, offset=DATA)
+        self.counters[:] = 0
+        self.write_info()
+        scani.add_stage(self)
+
+    def write_info(self):
+        "Writes the header and the metadata (model, channel names and rate)"
+        rate = 1.0 / self.scani.dt
+        meta = json.dumps(dict(model=self.scani.model, channames=self.scani.channames(),
+                               rate=rate)).encode()
+        if len(meta) > METASIZE:
+            raise RuntimeError("Metadata too long for the shared memory header!")
+        self.shm.buf[META:META+len(meta)] = meta
+        self.shm.buf[:WIDX] = header_fmt.pack(MAGIC, VERSION, self.nchans, self.nslots,
+                                              len(meta), rate)
+
+    def clear(self):
+        "Start of a new acquisition: the configuration might have changed"
+        self.write_info()
+        self.counters[1] += 1
+
+    def push(self, x):
+        "Writes a block of frames into the ring and then publishes the new write index"
+        n = x.shape[0]
+        if n == 0:
+            return
+        if n > self.nslots:
+            x = x[n-self.nslots:]
+        k = int(self.counters[0]) + n - x.shape[0]
+        i0 = k % self.nslots
+        n1 = min(x.shape[0], self.nslots - i0)
+        self.ring[i0:i0+n1] = x[:n1]
+        self.ring[:x.shape[0]-n1] = x[n1:]
+        self.counters[0] += n
+
+    def close(self):
+        "Stops publishing and frees the shared memory block"
+        if self.shm is None:
+            return
+        if self in self.scani.pack.stages:
+            self.scani.remove_stage(self)
+        self.counters = None
+        self.ring = None
+        owned.discard(self.shm.name)
+        self.shm.close()
+        self.shm.unlink()
+        self.shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class Subscriber(object):
+    """
+    Reads the frames published in the shared memory block `name`.
+
+    Only the frames written after the subscriber attached are read. The
+    producer is never stalled: if the subscriber falls behind more than the
+    size of the ring, the oldest frames are lost (see `lost`).
+    """
+    def __init__(self, name):
+        self.shm = attach(name)
+        buf = self.shm.buf
+        magic, version, nchans, nslots, nmeta, rate = header_fmt.unpack(bytes(buf[:WIDX]))
+        if magic != MAGIC:
+            raise RuntimeError("{} is not a scanivalve shared memory block!".format(name))
+        if version > VERSION:
+            raise RuntimeError("Shared memory version {} not supported!".format(version))
+        self.name = name
+        self.nchans = nchans
+        self.nslots = nslots
+        self.counters = np.ndarray((2,), np.uint64, buffer=buf, offset=WIDX)
+        self.ring = np.ndarray((nslots, nchans), np.float32, buffer=buf, offset=DATA)
+        self.ring.flags.writeable = False
+        self.cursor = self.windex()
+        self.lost = 0
+
+    def info(self):
+        "Metadata of the publisher: model, channel names and rate"
+        magic, version, nchans, nslots, nmeta, rate = header_fmt.unpack(bytes(self.shm.buf[:WIDX]))
+        return json.loads(bytes(self.shm.buf[META:META+nmeta]).decode())
+
+    def channames(self):
+        return self.info()['channames']
+
+    def rate(self):
+        return header_fmt.unpack(bytes(self.shm.buf[:WIDX]))[5]
+
+    def windex(self):
+        "Total number of frames written by the publisher"
+        return int(self.counters[0])
+
+    def generation(self):
+        "Number of acquisitions started by the publisher"
+        return int(self.counters[1])
+
+    def available(self):
+        "Frames not read yet (more than `nslots` means some were lost)"
+        return self.windex() - self.cursor
+
+    def poll(self, maxframes=None):
+        """
+        Zero copy views (at most two pieces) of the frames not read yet and
+        the number of frames lost since the last call.
+
+        The views point into the ring: they are only valid until the
+        publisher writes `nslots` more frames (see `valid`).
+        """
+        w = self.windex()
+        lost = 0
+        if w - self.cursor > self.nslots:
+            lost = w - self.nslots - self.cursor
+            self.cursor = w - self.nslots
+            self.lost += lost
+        k0 = self.cursor
+        k1 = w if maxframes is None else min(w, k0 + maxframes)
+        self.cursor = k1
+        i0 = k0 % self.nslots
+        n = k1 - k0
+        n1 = min(n, self.nslots - i0)
+        return [v for v in (self.ring[i0:i0+n1], self.ring[:n-n1]) if v.shape[0] > 0], lost
+
+    def valid(self, k0):
+        "Were the frames starting at frame `k0` overwritten?"
+        return self.windex() - k0 <= self.nslots
+
+    def read(self, maxframes=None):
+        """
+        Copy of the frames not read yet. Frames overwritten while copying
+        are dropped. Returns the pressure and the number of frames lost.
+        """
+        k0 = self.cursor
+        views, lost = self.poll(maxframes)
+        k0 += lost
+        p = np.concatenate(views) if views else np.zeros((0, self.nchans), np.float32)
+        over = self.windex() - self.nslots - k0
+        if over > 0:
+            p = p[over:]
+            lost += over
+            self.lost += over
+        return p, lost
+
+    def close(self):
+        self.counters = None
+        self.ring = None
+        self.shm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,367 @@
+"""
+# Scanivalve DSA-3017/3217 simulator
+
+TCP server speaking the subset of the DSA protocol used by this package:
+`SET`, `LIST S`, `LIST I`, `SCAN`, `STOP`, `CLEAR`, `ERROR`, `CALZ` and
+`STATUS`.
+During `SCAN` it sends binary EU frames (104 bytes, 112 bytes with the
+`TIME` fields on the 3217) paced by `PERIOD`, `AVG` and `FPS` or at a
+fixed `rate`.
+
+Faults can be injected to exercise the acquisition code:
+
+ * `fragment`: frames are sent in pieces of at most `fragment` bytes
+   (random sizes), so partial frames arrive at the client.
+ * `stall_every`, `stall_time`: the stream stops for `stall_time`
+   seconds every `stall_every` frames.
+ * `drop_every`: one frame out of every `drop_every` frames is not sent
+   (the frame timestamps show the gap).
+ * `disconnect_after`: the connection is closed (once) after that many frames.
+ * `garbage_every`: a few random bytes are inserted before one frame out
+   of every `garbage_every` frames, so the stream loses its alignment.
+
+```python
+import scanivalve, scanisim
+
+with scanisim.Simulator('3217', rate=10000) as sim:
+    s = scanivalve.Scanivalve('127.0.0.1', port=sim.port)
+    s.config(FPS=10000)
+    p, freq = s.acquire()
+```
+
+From the command line: `python scanisim.py --port 2323 --model 3217`.
+"""
+import socket
+import threading
+import time
+
+import numpy as np
+
+import scanivalve
+
+PTYPE_EU = 10
+
+
+def default_signal(k, t):
+    "Pressure of each channel: constant level plus a 1 Hz sine"
+    s = np.sin(2*np.pi*t)[:,np.newaxis]
+    return 100.0 * np.arange(1, 17) + 10.0 * s
+
+
+def counter_signal(k, t):
+    "Every channel is the frame index: handy to check that no frame was lost or repeated"
+    return np.repeat(k[:,np.newaxis].astype(np.float64), 16, axis=1)
+
+
+class Simulator(object):
+    """
+    Simulated scanivalve listening on `host`:`port` (a free port if 0, see
+    the `port` attribute).
+
+    * `model`: '3017' or '3217'
+    * `rate`: frames per second during SCAN. If `None` the rate set by
+      `PERIOD` and `AVG` is used. If 0, frames are sent as fast as possible.
+    * `signal`: function of the frame indexes and times (s) returning the
+      pressures with shape `(n, 16)`
+    * `prompt`: send the `>` prompt after each reply
+    * `calztime`: duration of the `CALZ` command in seconds
+    * `fragment`, `stall_every`, `stall_time`, `drop_every`,
+      `disconnect_after`, `garbage_every`: fault injection (see the module documentation)
+    """
+    def __init__(self, model='3217', host='127.0.0.1', port=0, rate=None,
+                 signal=default_signal, prompt=False, calztime=0.5,
+                 fragment=0, stall_every=0, stall_time=0.0, drop_every=0,
+                 disconnect_after=None, garbage_every=0, seed=0):
+        self.model = str(model)
+        self.rate = rate
+        self.signal = signal
+        self.prompt = prompt
+        self.calztime = calztime
+        self.fragment = fragment
+        self.stall_every = stall_every
+        self.stall_time = stall_time
+        self.drop_every = drop_every
+        self.disconnect_after = disconnect_after
+        self.garbage_every = garbage_every
+        self.garbage = 0
+        self.rng = np.random.default_rng(seed)
+
+        self.settings = dict(BIN='0', EU='1', UNITSCAN='PSI', XSCANTRIG='0', QPKTS='0',
+                             TIME='0', SIM='0', AVG='16', PERIOD='500', FPS='1')
+        if self.model == '3017':
+            del self.settings['TIME']
+        self.info = dict(MODEL=self.model, SN='S{}0001'.format(self.model),
+                         VER='SIM', IPADD=host)
+        self.zero = np.zeros(16)
+        self.errors = []
+        self.status = 'READY'
+        self.scanning = threading.Event()
+        self.trig = threading.Event()
+        self.stream = None
+        self.client = None
+        self.clients = []
+        self.framessent = 0
+
+        self.srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.srv.bind((host, port))
+        self.srv.listen(8)
+        self.host = host
+        self.port = self.srv.getsockname()[1]
+        self.running = True
+        self.thread = threading.Thread(target=self.accept, daemon=True)
+        self.thread.start()
+
+    def accept(self):
+        while self.running:
+            try:
+                c, addr = self.srv.accept()
+            except OSError:
+                break
+            c.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.clients.append(c)
+            threading.Thread(target=self.handle, args=(c,), daemon=True).start()
+
+    def handle(self, c):
+        "Reads and executes the commands of a client"
+        buf = b''
+        try:
+            while True:
+                data = c.recv(4096)
+                if not data:
+                    break
+                buf += data
+                while b'\n' in buf:
+                    line, buf = buf.split(b'\n', 1)
+                    self.command(c, line.decode(errors='replace').strip())
+        except OSError:
+            pass
+        finally:
+            if self.client is c:
+                self.halt()
+            c.close()
+            if c in self.clients:
+                self.clients.remove(c)
+
+    def reply(self, c, lines):
+        msg = ''.join(l + '\r\n' for l in lines)
+        if self.prompt:
+            msg += '>'
+        if msg:
+            c.sendall(msg.encode())
+
+    def command(self, c, line):
+        words = line.upper().split()
+        if not words:
+            return
+        cmd = words[0]
+        if self.scanning.is_set() and cmd != 'STOP':
+            # Only STOP is accepted while scanning
+            return
+        if self.status == 'CALZ' and cmd not in ('STATUS', 'LIST'):
+            self.errors.append('ERROR: {} while zeroing'.format(cmd))
+            return
+        if cmd == 'SET' and len(words) == 3:
+            var, val = words[1], words[2]
+            if var not in self.settings:
+                self.errors.append('ERROR: SET {} not recognized'.format(var))
+            else:
+                self.settings[var] = val
+        elif cmd == 'LIST' and len(words) == 2:
+            if words[1] == 'S':
+                self.reply(c, ['SET {} {}'.format(k, v) for k, v in self.settings.items()])
+            elif words[1] == 'I':
+                self.reply(c, ['SET {} {}'.format(k, v) for k, v in self.info.items()])
+            else:
+                self.errors.append('ERROR: LIST {} not implemented'.format(words[1]))
+                self.reply(c, [])
+        elif cmd == 'SCAN':
+            self.scan(c)
+        elif cmd == 'STOP':
+            self.halt()
+        elif cmd == 'CLEAR':
+            self.errors = []
+        elif cmd == 'ERROR':
+            self.reply(c, self.errors if self.errors else ['NO ERRORS'])
+        elif cmd == 'CALZ':
+            if self.status != 'CALZ':
+                self.status = 'CALZ'
+                threading.Thread(target=self.calz, daemon=True).start()
+        elif cmd == 'STATUS':
+            self.reply(c, ['STATUS: {}'.format(self.status)])
+        else:
+            self.errors.append('ERROR: {} not recognized'.format(line))
+
+    def calz(self):
+        "Zero calibration: the current level of every channel becomes the zero"
+        time.sleep(self.calztime)
+        k = np.arange(64)
+        self.zero = self.signal(k, k * self.frametime()).mean(0)
+        self.status = 'READY'
+
+    def frametime(self):
+        "Time between frames in seconds"
+        if self.rate is None:
+            return int(self.settings['PERIOD']) * 1e-6 * 16 * int(self.settings['AVG'])
+        elif self.rate == 0:
+            return 0.0
+        return 1.0 / self.rate
+
+    def tinfo(self):
+        return self.model == '3217' and int(self.settings.get('TIME', 0)) > 0
+
+    def scan(self, c):
+        if self.stream is not None:
+            # The last frames of the previous scan might still be going out
+            self.stream.join()
+        self.scanning.set()
+        self.status = 'SCAN'
+        self.client = c
+        self.stream = threading.Thread(target=self.send_frames, args=(c,), daemon=True)
+        self.stream.start()
+
+    def halt(self):
+        "Stops the scan and waits for the stream to finish"
+        self.scanning.clear()
+        stream = self.stream
+        if stream is not None and stream is not threading.current_thread():
+            stream.join(1.0)
+        self.stream = None
+        if self.status == 'SCAN':
+            self.status = 'READY'
+
+    def trigger(self):
+        "External trigger: starts the scans waiting for it (XSCANTRIG=1)"
+        self.trig.set()
+
+    def frames(self, k0, n, dt):
+        "Binary EU frames `k0` to `k0+n`"
+        tinfo = self.tinfo()
+        fr = np.zeros(n, scanivalve.frame_dtype(tinfo))
+        k = np.arange(k0, k0+n)
+        t = k * dt
+        fr['ptype'] = PTYPE_EU
+        fr['size'] = fr.dtype.itemsize
+        fr['press'] = self.signal(k, t) - self.zero
+        fr['temp'] = 25.0
+        if tinfo:
+            # TIME 1: ms, TIME 2: μs
+            us = self.settings['TIME'] == '2'
+            fr['time'] = (np.round(t * (1e6 if us else 1e3)).astype(np.int64) + 2**31) % 2**32 - 2**31
+            fr['tunit'] = 1 if us else 0
+        if self.drop_every > 0:
+            keep = (k + 1) % self.drop_every != 0
+            fr = fr[keep]
+            k = k[keep]
+        if self.garbage_every <= 0:
+            return fr.tobytes()
+        raw = fr.view(np.uint8).reshape(len(fr), -1)
+        out = []
+        i0 = 0
+        for i in np.flatnonzero((k + 1) % self.garbage_every == 0):
+            n = int(self.rng.integers(1, 8))
+            out.append(raw[i0:i].tobytes())
+            out.append(self.rng.integers(0, 256, n, np.uint8).tobytes())
+            self.garbage += n
+            i0 = i
+        out.append(raw[i0:].tobytes())
+        return b''.join(out)
+
+    def send(self, c, data):
+        if self.fragment <= 0:
+            c.sendall(data)
+            return
+        i = 0
+        while i < len(data):
+            n = int(self.rng.integers(1, self.fragment + 1))
+            c.sendall(data[i:i+n])
+            i += n
+
+    def send_frames(self, c):
+        "Streams the frames of a scan"
+        fps = int(self.settings['FPS'])
+        dt = self.frametime()
+        tframe = dt if dt > 0 else int(self.settings['PERIOD']) * 1e-6 * 16 * int(self.settings['AVG'])
+        if self.settings['XSCANTRIG'] == '1':
+            while not self.trig.wait(0.05):
+                if not self.scanning.is_set():
+                    return
+            self.trig.clear()
+        k = 0
+        t0 = time.monotonic()
+        try:
+            while self.scanning.is_set() and (fps == 0 or k < fps):
+                if dt > 0:
+                    # Frames due by now
+                    n = int((time.monotonic() - t0) / dt) + 1 - k
+                    if n <= 0:
+                        time.sleep(min(dt * (1 - n), 0.01))
+                        continue
+                else:
+                    n = 1024
+                n = min(n, 1024)
+                if fps > 0:
+                    n = min(n, fps - k)
+                if self.stall_every > 0:
+                    n = min(n, self.stall_every - k % self.stall_every)
+                if self.disconnect_after is not None:
+                    n = min(n, self.disconnect_after - self.framessent)
+                    if n <= 0:
+                        # Only once: the client should be able to reconnect
+                        self.disconnect_after = None
+                        c.shutdown(socket.SHUT_RDWR)
+                        c.close()
+                        break
+                if fps > 0 and k + n == fps:
+                    # Commands sent right after the last frame are accepted
+                    self.scanning.clear()
+                self.send(c, self.frames(k, n, tframe))
+                k += n
+                self.framessent += n
+                if self.stall_every > 0 and k % self.stall_every == 0:
+                    t1 = time.monotonic() + self.stall_time
+                    while self.scanning.is_set() and time.monotonic() < t1:
+                        time.sleep(0.01)
+        except OSError:
+            pass
+        finally:
+            self.scanning.clear()
+            if self.status == 'SCAN':
+                self.status = 'READY'
+
+    def close(self):
+        self.running = False
+        self.scanning.clear()
+        try:
+            self.srv.close()
+        except OSError:
+            pass
+        for c in list(self.clients):
+            try:
+                c.shutdown(socket.SHUT_RDWR)
+                c.close()
+            except OSError:
+                pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Scanivalve DSA simulator')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=23)
+    parser.add_argument('--model', default='3217', choices=['3017', '3217'])
+    parser.add_argument('--rate', type=float, default=None, help='frames/s (0: as fast as possible)')
+    args = parser.parse_args()
+    sim = Simulator(args.model, args.host, args.port, args.rate)
+    print("Scanivalve {} simulator on {}:{}".format(args.model, args.host, sim.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        sim.close()
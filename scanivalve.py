@@ -2,7 +2,12 @@ import socket
 import numpy as np
 from select import select
 import threading
+import queue
+import asyncio
 import time
+import mmap
+import json
+import os
 
 
 def clamp(x,min,max):
@@ -41,6 +46,518 @@ def check_server(ip='191.30.80.131', port=23, timeout=3):
 
 
 
+def packet_layout(model, tinfo=True):
+    """
+    Layout of the binary EU packets sent by the scanivalve model `model`.
+
+    Returns a dictionary with the packet length and the byte slices of each field.
+    """
+    if model=='3017':
+        tinfo = False
+        press = slice(8, 72)
+        temp = slice(72,104)
+        packlen = 104
+        tt = None
+        tunit = None
+    elif model=='3217':
+        press = slice(8, 72)
+        temp = slice(72,104)
+        if tinfo:
+            packlen = 112
+            tt = slice(104, 108)
+            tunit = slice(108, 112)
+            
+        else:
+            packlen = 104
+            tt = None
+            tunit =  None
+    else:
+        raise RuntimeError("Model {} not recognized!".format(model))
+    
+    return dict(model=model, packlen=packlen, press=press, temp=temp, t=tinfo, time=tt, tunit=tunit)
+
+
+def parse_list(buffer):
+    "Splits the reply to a LIST command into lines of words"
+    buffer = bytes(buffer).rstrip()
+    if buffer.endswith(b'>'):
+        buffer = buffer[:-1]
+    return [b.split(' ') for b in  buffer.decode().strip().split('\r\n')]
+
+
+REPLY_PARTIAL = 0
+REPLY_LINE = 1
+REPLY_DONE = 2
+
+def reply_status(buffer, nlines=None):
+    """
+    Checks whether `buffer` holds the complete reply to a command.
+
+    Returns `REPLY_DONE` if the reply ends with the prompt or has the
+    expected number of lines `nlines`, `REPLY_LINE` if it ends at a line
+    boundary (the reply may or may not be over) and `REPLY_PARTIAL` if a
+    line is still being received.
+    """
+    tail = buffer[-4:].rstrip(b' ')
+    if tail.endswith(b'>'):
+        return REPLY_DONE
+    if not tail.endswith(b'\r\n'):
+        return REPLY_PARTIAL
+    if nlines is not None and buffer.count(b'\r\n') >= nlines:
+        return REPLY_DONE
+    return REPLY_LINE
+
+
+def config_value(model, K, x):
+    """
+    Checks and clamps the value `x` of acquisition parameter `K` for
+    scanivalve `model`.
+    """
+    isold = model=='3017'
+    if K == 'XSCANTRIG':
+        return int(x)
+    elif K=='PERIOD':
+        x = int(x)
+        return clamp(x, 500, 62500)  if isold else clamp(x, 160, 650000)
+    elif K=='AVG':
+        x = int(x)
+        return clamp(x, 1, 32767) if isold else clamp(x, 1, 240)
+    elif K=='FPS':
+        x = int(x)
+        # FPS=0 scans continuously until STOP
+        return clamp(x, 0, 2**31) if isold else clamp(x, 0, 2**30)
+    else:
+        raise RuntimeError("Illegal configuration. SET {} {} not implemented!".format(K, x))
+
+
+def same_value(a, b):
+    "Compares a configuration value sent to the scanivalve with the value it reports"
+    a = str(a).strip().upper()
+    b = str(b).strip().upper()
+    if a == b:
+        return True
+    try:
+        return float(a) == float(b)
+    except ValueError:
+        return False
+
+    
+def pending_settings(settings, devstate):
+    """
+    Returns the `(var, val)` pairs of `settings` that are not known to be set
+    on the device according to the cached state `devstate`.
+    """
+    if hasattr(settings, 'items'):
+        settings = settings.items()
+    pending = []
+    for var, val in settings:
+        var = var.upper()
+        if var in devstate and same_value(val, devstate[var]):
+            continue
+        pending.append((var, val))
+    return pending
+
+
+def check_settings(pending, devstate):
+    "Checks that the settings `pending` were applied according to the readback `devstate`"
+    bad = ["{}={} (device: {})".format(var, val, devstate[var])
+           for var, val in pending if var in devstate and not same_value(val, devstate[var])]
+    if bad:
+        raise RuntimeError("Scanivalve did not accept the configuration: {}".format(', '.join(bad)))
+
+
+def frame_dtype(tinfo):
+    """
+    Structured dtype describing a single binary EU frame.
+
+    The frame is made up of an 8 byte header, 16 float32 pressures,
+    8 float32 temperatures and, if time information is enabled (`tinfo`),
+    the int32 frame time and the int32 time unit.
+    """
+    fields = [('ptype', '<i4'), ('size', '<i4'),
+              ('press', '<f4', (16,)), ('temp', '<f4', (8,))]
+    if tinfo:
+        fields += [('time', '<i4'), ('tunit', '<i4')]
+    return np.dtype(fields)
+
+
+def block_mean(x, n, dtype=np.float64):
+    """
+    Averages blocks of `n` consecutive rows of `x`. The last block may be shorter.
+    """
+    if n <= 1:
+        return x.astype(dtype)
+    nrows = x.shape[0]
+    if nrows == 0:
+        return np.zeros((0,) + x.shape[1:], dtype)
+    idx = np.arange(0, nrows, n)
+    count = np.minimum(n, nrows - idx).astype(dtype)
+    return np.add.reduceat(x, idx, axis=0, dtype=dtype) / count[:,np.newaxis]
+
+
+def timing_stats(t):
+    """
+    Statistics of the frame timestamps `t` (see `Packet.get_timestamps`).
+
+    Returns a dictionary with:
+    * `dt`: nominal sampling time (median interval between frames)
+    * `rate`: nominal frame rate
+    * `effective_rate`: frames received per second of acquisition
+    * `dropped`: number of frames missing (gaps longer than `dt`)
+    * `duplicated`: number of repeated or out of order frames
+    * `jitter_rms` and `jitter_max`: deviation of the intervals from `dt`
+    * `maxgap`: longest interval between frames
+    """
+    n = len(t)
+    if n < 2:
+        raise RuntimeError("At least two frames are needed for timing statistics!")
+    d = np.diff(t)
+    dt = float(np.median(d))
+    span = t[-1] - t[0]
+    if dt <= 0:
+        raise RuntimeError("Invalid frame timestamps!")
+    steps = np.rint(d / dt)
+    single = steps == 1
+    jitter = d[single] - dt
+    return dict(nframes=n, dt=dt, rate=1.0/dt,
+                effective_rate=float((n-1)/span) if span > 0 else float('nan'),
+                dropped=int((steps[steps > 1] - 1).sum()),
+                duplicated=int((d <= 0).sum()),
+                jitter_rms=float(np.sqrt(np.mean(jitter**2))) if len(jitter) > 0 else 0.0,
+                jitter_max=float(np.abs(jitter).max()) if len(jitter) > 0 else 0.0,
+                maxgap=float(d.max()))
+
+
+METRICS = [('scans', 'counter', "Number of scans started"),
+           ('scans_stopped', 'counter', "Number of scans stopped before all frames were received"),
+           ('recv_calls', 'counter', "Number of recv calls"),
+           ('bytes_received', 'counter', "Bytes received from the scanivalve"),
+           ('frames_received', 'counter', "Frames received from the scanivalve"),
+           ('bytes_per_recv', 'gauge', "Average number of bytes per recv call"),
+           ('max_frame_gap', 'gauge', "Longest time between frames in the last scan (s)"),
+           ('overflow', 'gauge', "Frames dropped in the last scan (ring buffer full)"),
+           ('overflow_total', 'counter', "Frames dropped (ring buffer full)"),
+           ('resyncs', 'counter', "Frames with a bad header (stream resynchronized)"),
+           ('bytes_discarded', 'counter', "Bytes discarded to resynchronize the stream"),
+           ('frames_decoded', 'counter', "Frames decoded"),
+           ('decode_time', 'counter', "Time spent decoding frames (s)")]
+
+COMMAND_METRICS = [('command_calls', 'count', 'counter', "Commands sent"),
+                   ('command_seconds', 'mean', 'gauge', "Mean round trip of the commands (s)"),
+                   ('command_max_seconds', 'max', 'gauge', "Longest round trip of the commands (s)")]
+
+def prometheus_text(stats, prefix='scanivalve', labels=None):
+    """
+    Formats the dictionary returned by `Scanivalve.stats` in the Prometheus
+    text exposition format, with `labels` on every sample.
+
+    `stats` and `labels` may also be lists (one item per module): each
+    metric family is written once, with one sample per item.
+    """
+    if isinstance(stats, dict):
+        stats = [stats]
+        labels = [labels]
+    elif labels is None:
+        labels = [None] * len(stats)
+    def fmt(lab, extra={}):
+        lab = dict(lab or {}, **extra)
+        if not lab:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(k, v) for k, v in lab.items()) + '}'
+    lines = []
+    for name, kind, help in METRICS:
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for st, lab in zip(stats, labels):
+            lines.append('{}_{}{} {}'.format(prefix, name, fmt(lab), st[name]))
+    for name, field, kind, help in COMMAND_METRICS:
+        samples = [(lab, cmd, c) for st, lab in zip(stats, labels)
+                   for cmd, c in st.get('commands', {}).items()]
+        if not samples:
+            continue
+        lines.append('# HELP {}_{} {}'.format(prefix, name, help))
+        lines.append('# TYPE {}_{} {}'.format(prefix, name, kind))
+        for lab, cmd, c in samples:
+            lines.append('{}_{}{} {}'.format(prefix, name, fmt(lab, dict(command=cmd)), c[field]))
+    return '\n'.join(lines) + '\n'
+
+    
+def load_frames(filename):
+    """
+    Opens the frames of an acquisition to a memory mapped file (see the
+    `MEMMAP` option of `Scanivalve.config`) as a read only structured array.
+
+    Nothing is loaded into memory: `frames['press']` and `frames['temp']`
+    are lazy views over the file. Frames that were never received (an
+    interrupted acquisition) are left out.
+    """
+    with open(filename + '.json') as f:
+        info = json.load(f)
+    frames = np.memmap(filename, frame_dtype(info['t']), 'r', shape=(info['nframes'],))
+    # The file is zero filled: frames never received have a zeroed header
+    received = np.flatnonzero((frames['ptype'] != 0) | (frames['size'] != 0))
+    nframes = received[-1] + 1 if len(received) > 0 else 0
+    return frames[:nframes]
+
+
+CALFILE = os.path.join(os.path.expanduser('~'), '.scanivalve', 'calibration.json')
+
+class Calibration(object):
+    """
+    Software calibration of the pressure channels.
+
+    The corrected pressure is `gain * (p - offset)` or, if `poly` is given
+    (coefficients of each channel, highest power first, shape
+    `(ncoefs, nchans)`), `polyval(poly, p - offset)`.
+
+    The correction is applied while the frames are decoded, in blocks
+    that fit in the cache, so the output is written in a single pass.
+    """
+    def __init__(self, offset=None, gain=None, poly=None, nchans=16, serial=None, time=None):
+        self.nchans = nchans
+        self.offset = np.zeros(nchans) if offset is None else np.asarray(offset, np.float64)
+        self.gain = np.ones(nchans) if gain is None else np.asarray(gain, np.float64)
+        self.poly = None if poly is None else np.asarray(poly, np.float64)
+        self.serial = serial
+        self.time = time
+        self.block = 8192
+
+    def apply(self, x, out):
+        "Writes the corrected pressure `x` (shape `(n, nchans)`, any dtype) into `out`"
+        unit = self.poly is None and np.all(self.gain == 1)
+        offset = self.offset.astype(out.dtype)
+        gain = self.gain.astype(out.dtype)
+        for i in range(0, x.shape[0], self.block):
+            o = out[i:i+self.block]
+            np.subtract(x[i:i+self.block], offset, out=o, casting='unsafe')
+            if self.poly is not None:
+                u = o.copy()
+                o[...] = self.poly[0]
+                for c in self.poly[1:]:
+                    o *= u
+                    o += c.astype(out.dtype)
+            elif not unit:
+                o *= gain
+        return out
+
+    def to_dict(self):
+        return dict(offset=self.offset.tolist(), gain=self.gain.tolist(),
+                    poly=None if self.poly is None else self.poly.tolist(),
+                    nchans=self.nchans, time=self.time)
+
+    @classmethod
+    def from_dict(cls, d, serial=None):
+        return cls(d['offset'], d.get('gain'), d.get('poly'), d.get('nchans', 16), serial, d.get('time'))
+
+    
+def load_calibration(serial, filename=CALFILE):
+    "Calibration of the module with serial number `serial` saved in `filename` (`None` if not found)"
+    if not os.path.exists(filename):
+        return None
+    with open(filename) as f:
+        cals = json.load(f)
+    if serial not in cals:
+        return None
+    return Calibration.from_dict(cals[serial], serial)
+
+
+def save_calibration(cal, filename=CALFILE):
+    "Saves the calibration `cal` in `filename`, keyed by the serial number of the module"
+    if cal.serial is None:
+        raise RuntimeError("Calibration without the serial number of the module!")
+    cals = {}
+    if os.path.exists(filename):
+        with open(filename) as f:
+            cals = json.load(f)
+    else:
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    cals[cal.serial] = cal.to_dict()
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(cals, f, indent=1)
+    os.replace(tmp, filename)
+
+    
+class ChannelStats(object):
+    """
+    Streaming statistics of each channel: number of samples, mean,
+    standard deviation, RMS, minimum and maximum.
+
+    Blocks of frames are combined with the parallel version of Welford's
+    algorithm (Chan et al.), vectorized over the channels, so the
+    statistics are numerically stable and no sample has to be kept.
+    """
+    def __init__(self, nchans=16):
+        self.nchans = nchans
+        self.reset()
+
+    def reset(self):
+        self.n = 0
+        self.mean = np.zeros(self.nchans)
+        self.m2 = np.zeros(self.nchans)
+        self.min = np.full(self.nchans, np.inf)
+        self.max = np.full(self.nchans, -np.inf)
+
+    def update(self, x):
+        "Adds a block of samples with shape `(nsamples, nchans)`"
+        nb = x.shape[0]
+        if nb == 0:
+            return
+        x = x.astype(np.float64)
+        bmean = x.mean(0)
+        bm2 = ((x - bmean)**2).sum(0)
+        self.combine(nb, bmean, bm2, x.min(0), x.max(0))
+
+    def combine(self, nb, bmean, bm2, bmin, bmax):
+        n = self.n + nb
+        delta = bmean - self.mean
+        self.mean = self.mean + delta * (nb / n)
+        self.m2 = self.m2 + bm2 + delta**2 * (self.n * nb / n)
+        self.n = n
+        np.minimum(self.min, bmin, out=self.min)
+        np.maximum(self.max, bmax, out=self.max)
+        
+    def merge(self, other):
+        "Adds the statistics of another `ChannelStats` object"
+        if other.n > 0:
+            self.combine(other.n, other.mean, other.m2, other.min, other.max)
+
+    def var(self, ddof=1):
+        return self.m2 / max(1, self.n - ddof)
+
+    def std(self, ddof=1):
+        return np.sqrt(self.var(ddof))
+
+    def rms(self):
+        return np.sqrt(self.m2 / max(1, self.n) + self.mean**2)
+
+    def copy(self):
+        s = ChannelStats(self.nchans)
+        s.merge(self)
+        return s
+
+    def result(self):
+        "Dictionary with the statistics"
+        return dict(n=self.n, mean=self.mean.copy(), std=self.std(), rms=self.rms(),
+                    min=self.min.copy(), max=self.max.copy())
+
+
+class DecimationStage(object):
+    """
+    Base class of the pipeline stages run on the pressure frames as they
+    are received (see `Packet.add_stage`).
+
+    Each stage reduces the frame rate by `n`. Blocks of frames with shape
+    `(nframes, nchans)` are processed by `process`, which keeps whatever
+    state is needed across blocks, and the output is accumulated until
+    `read` is called. Several stages can run on the same acquisition,
+    each one with its own output rate.
+    """
+    def __init__(self, n):
+        if n < 1:
+            raise RuntimeError("Decimation factor should be at least 1!")
+        self.n = int(n)
+        self.lock = threading.Lock()
+        self.out = []
+        self.reset()
+
+    def reset(self):
+        "Clears the state of the stage (start of a new acquisition)"
+        pass
+
+    def process(self, x):
+        "Decimates the block `x`. Returns the output frames"
+        raise NotImplementedError()
+
+    def push(self, x):
+        "Processes a block of frames and stores the output"
+        if x.shape[0] == 0:
+            return
+        y = self.process(x.astype(np.float64))
+        if y.shape[0] > 0:
+            with self.lock:
+                self.out.append(y)
+
+    def read(self, dtype=np.float64):
+        "Output frames since the last call"
+        with self.lock:
+            out = self.out
+            self.out = []
+        if not out:
+            return np.zeros((0, 16), dtype)
+        return np.concatenate(out).astype(dtype, copy=False)
+
+    def clear(self):
+        "Clears the state and discards the output"
+        self.reset()
+        with self.lock:
+            self.out = []
+
+            
+class BlockMean(DecimationStage):
+    "Mean of each block of `n` frames"
+    def reset(self):
+        self.rem = None
+
+    def process(self, x):
+        if self.rem is not None:
+            x = np.concatenate([self.rem, x])
+        m = x.shape[0] // self.n
+        self.rem = x[m*self.n:].copy()
+        return x[:m*self.n].reshape(m, self.n, x.shape[1]).mean(1)
+
+    
+class Downsample(DecimationStage):
+    "Keeps one frame out of every `n` frames (no filtering)"
+    def reset(self):
+        self.skip = 0
+
+    def process(self, x):
+        y = x[self.skip::self.n]
+        self.skip = (self.skip - x.shape[0]) % self.n
+        return y
+
+    
+class FIRDecimator(DecimationStage):
+    """
+    FIR filter with coefficients `taps` followed by downsampling by `n`.
+    The filter is only evaluated at the output frames.
+    """
+    def __init__(self, n, taps):
+        self.taps = np.asarray(taps, np.float64)
+        super().__init__(n)
+
+    def reset(self):
+        self.hist = None
+        self.skip = 0
+
+    def process(self, x):
+        ntaps = len(self.taps)
+        if self.hist is not None:
+            x = np.concatenate([self.hist, x])
+        self.hist = x[x.shape[0] - min(ntaps-1, x.shape[0]):].copy()
+        nwin = x.shape[0] - ntaps + 1
+        if nwin <= 0:
+            return np.zeros((0, x.shape[1]))
+        win = np.lib.stride_tricks.sliding_window_view(x, ntaps, axis=0)[self.skip::self.n]
+        self.skip = (self.skip - nwin) % self.n
+        return win @ self.taps[::-1]
+
+    
+class CICDecimator(FIRDecimator):
+    """
+    Cascaded integrator-comb decimator of order `order`, normalized to unit
+    gain. Implemented by its equivalent FIR filter (boxcar of length `n`
+    convolved `order` times).
+    """
+    def __init__(self, n, order=3):
+        taps = np.ones(1)
+        for i in range(order):
+            taps = np.convolve(taps, np.ones(n))
+        super().__init__(n, taps / taps.sum())
+        self.order = order
+
+    
 class Packet(object):
     """
     Handles EU with time DSA-3217 packets
@@ -54,69 +571,627 @@ class Packet(object):
         self.t = packet_info['t']
         self.time = packet_info['time']
         self.tunit = packet_info['tunit']
+        self.dtype = self.frame_dtype()
         
         self.acquiring = False
         self.samplesread = 0
         self.fps = 1
+        self.continuous = False
+        self.nread = 0
+        self.overflow = 0
+        self.nbytes = 0
+        self.dropped = 0
+        self.dropping = False
+        self.chunksize = 65536
+        self.releasesize = 64*1024*1024
+        self.statsframes = 8192
+        self.chanstats = None
+        self.statsonly = False
+        self.ring = False
+        self.stages = []
+        self.cal = None
+        # External trigger (XSCANTRIG): no timeout before the first frame
+        self.xtrig = False
+        # Header (first 8 bytes) of every frame, learned from the first frames (see `find_header`)
+        self.validate = True
+        self.header = None
+        self.resyncs = []
+        self.scanbytes = 0
+
+        # Counters, never reset: see `stats`
+        self.nrecv = 0
+        self.bytesrecv = 0
+        self.framesrecv = 0
+        self.overflowtotal = 0
+        self.maxgap = 0.0
+        self.decodetime = 0.0
+        self.framesdecoded = 0
+        self.resynctotal = 0
+        self.bytesdiscarded = 0
+        self.scans = 0
+        self.scansstopped = 0
+        self.onscan = None
+        self.gaps = []
+        self.gaptime = 0.0
+        # Wakes up the receive loop when the acquisition is stopped
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
 
         self.buf = None
+        self.flat = None
+        self.pool = None
+        self.mmap = None
+        self.filename = None
+        self.released = 0
+        self.scratch = np.zeros(self.packlen, np.uint8)
         self.allocbuffer(1)
         self.dataread = False
         self.time1 = None
         self.time2 = None
         self.timeN = None
+        self.n2 = 1
         self.stop_reading = False
         
-    def allocbuffer(self, fps):
+    def allocbuffer(self, fps, ringsize=65536, filename=None, statsonly=False):
         """
         Allocates a buffer with `fps` elements
+
+        If `fps` is 0, the scanivalve scans continuously and the buffer is
+        a ring buffer with `ringsize` frames. Memory use is bounded by the
+        ring size no matter how long the acquisition lasts.
+
+        If `filename` is given, the buffer is a memory mapped file: frames go
+        straight to disk and survive a crash of the acquisition process. The
+        frames can later be opened with `load_frames`. Not available for
+        continuous acquisitions: the order of the frames in a ring is lost.
+
+        If `statsonly` is true, the frames are not stored: only the channel
+        statistics (`chanstats`) are computed and the buffer is a small ring
+        that is reused as soon as the statistics are updated.
+
+        Buffers in memory come from a pool (see `getbuffer`): they are not
+        zeroed and allocating one of the same or smaller size is free.
         """
-        self.buf = np.zeros((fps, self.packlen), np.uint8)
+        if filename is not None and fps == 0 and not statsonly:
+            raise RuntimeError("MEMMAP needs a finite acquisition (FPS > 0)!")
+        self.continuous = fps == 0
+        self.statsonly = statsonly
+        self.ring = self.continuous or statsonly
+        if statsonly:
+            self.chanstats = ChannelStats(16)
+            nbuf = min(fps, self.statsframes) if fps > 0 else self.statsframes
+            filename = None
+        else:
+            nbuf = ringsize if self.continuous else fps
+        self.flat = None
+        self.buf = None
+        self.close_mmap()
+        if filename is None:
+            self.buf = self.getbuffer(nbuf)
+        else:
+            nb = nbuf * self.packlen
+            with open(filename, 'w+b') as f:
+                f.truncate(nb)
+                self.mmap = mmap.mmap(f.fileno(), nb)
+            self.buf = np.frombuffer(self.mmap, np.uint8).reshape(nbuf, self.packlen)
+            with open(filename + '.json', 'w') as f:
+                json.dump(dict(model=self.model, packlen=self.packlen, t=self.t,
+                               nframes=nbuf), f)
+        self.flat = memoryview(self.buf).cast('B')
+        self.filename = filename
+        self.released = 0
         self.fps = fps
-    def scan(self, s, dt):
+
+    def getbuffer(self, nbuf):
+        """
+        Frame buffer with `nbuf` frames taken from the buffer pool: the
+        memory of the largest buffer allocated so far is kept and reused, so
+        back to back acquisitions of the same or smaller size neither
+        allocate nor touch new pages. The buffer is not zeroed, only the
+        frames received are ever read.
+        """
+        if self.pool is None or self.pool.shape[0] < nbuf:
+            # The old pool is dropped first: both are never alive at once
+            self.pool = None
+            self.pool = np.empty((nbuf, self.packlen), np.uint8)
+        return self.pool[:nbuf]
+
+    def free_pool(self):
+        "Gives back the memory of the buffer pool not used by the current buffer. Unread frames are lost"
+        if self.acquiring:
+            raise RuntimeError("Still acquiring data from scanivalve!")
+        if self.mmap is None and self.pool is not None and self.pool.shape[0] > self.buf.shape[0]:
+            self.flat = None
+            self.pool = np.empty(self.buf.shape, np.uint8)
+            self.buf = self.pool
+            self.flat = memoryview(self.buf).cast('B')
+            self.clear()
+
+    def release_pages(self):
+        """
+        Writes the frames received so far into the memory mapped file and
+        drops them from the resident memory of the process. They are read
+        back from the file when accessed.
+        """
+        start = self.released
+        end = self.nbytes - self.nbytes % mmap.PAGESIZE
+        if self.mmap is None or self.ring or end <= start:
+            return
+        self.mmap.flush(start, end-start)
+        if hasattr(mmap, 'MADV_DONTNEED'):
+            # Not on Windows: the pages are only written back there
+            self.mmap.madvise(mmap.MADV_DONTNEED, start, end-start)
+        self.released = end
+
+    def close_mmap(self):
+        "Unmaps the memory mapped file, if any (the frame buffer should be dropped first)"
+        if self.mmap is None:
+            return
+        try:
+            self.mmap.close()
+        except BufferError:
+            # Views of the frames still in use: unmapped once they are gone
+            pass
+        self.mmap = None
+
+    def frame_dtype(self):
+        "Structured dtype describing a single binary EU frame. See `frame_dtype`"
+        dtype = frame_dtype(self.t)
+        if dtype.itemsize != self.packlen:
+            raise RuntimeError("Frame layout does not match packet length {}!".format(self.packlen))
+        return dtype
+
+    def frames(self):
+        """
+        Structured view (no copy) over the frames read so far.
+        """
+        return self.buf[:self.samplesread].view(self.dtype)[:,0]
+
+    def scan(self, s, dt, barrier=None, resume=False):
         """
         Execute the scan command and read the frames into a buffer.
+
+        If a `threading.Barrier` is given, the SCAN command is only sent
+        once every thread sharing the barrier is ready. With `resume=True`
+        the frames are appended to those already received (see `mark_gap`).
+
+        The scan fails if no frame arrives for `max(0.5, 3*dt)` seconds,
+        except before the first frame when waiting for the external trigger
+        (`xtrig`).
         """
-        fps = self.fps
-        self.dt = dt
-        s.settimeout(max(0.5, 3 * dt))
+        timeout = max(0.5, 3 * dt)
+        oldtimeout = s.gettimeout()
+        if barrier is not None:
+            barrier.wait()
         s.send(b"SCAN\n")
+        if resume:
+            self.acquiring = True
+        else:
+            self.begin(dt)
 
+        # Non blocking: only wait (for the data or for `stop`) when nothing is pending
+        s.setblocking(False)
+        try:
+            while not self.stop_reading:
+                try:
+                    n = s.recv_into(self.recv_view())
+                except BlockingIOError:
+                    wait = None if self.xtrig and self.nbytes == 0 else timeout
+                    r, w, x = select([s, self.wakeup], [], [], wait)
+                    if self.wakeup in r:
+                        self.clear_wakeup()
+                    elif not r:
+                        if self.stop_reading:
+                            break
+                        raise socket.timeout("timed out")
+                    continue
+                if n == 0:
+                    raise ConnectionError("Scanivalve closed the connection!")
+                self.advance(n)
+                if self.finished():
+                    break
+            else:
+                if not self.continuous:
+                    self.scansstopped += 1
+        finally:
+            s.settimeout(oldtimeout)
+            self.acquiring = False
+            if self.onscan is not None:
+                self.onscan(self.stats())
+
+    def begin(self, dt):
+        "Marks the start of a scan, right after the SCAN command was sent"
+        self.dt = dt
         self.acquiring = True
+        for stage in self.stages:
+            stage.clear()
+        self.scans += 1
+        self.maxgap = 0.0
         self.time1 = time.monotonic()
 
-        s.recv_into(self.buf[0], self.packlen)
+    def mark_gap(self, tresume):
+        """
+        Records a gap in the acquisition before resuming the scan at time
+        `tresume` (`time.monotonic()`): an incomplete frame is discarded and
+        the number of frames missed is estimated from the time since the
+        last frame. `gaps` is a list of `(frame, missing frames, seconds)`.
+        """
+        self.nbytes -= self.nbytes % self.packlen
+        self.dropping = False
+        self.dropped = 0
+        k = self.samplesread
+        tlast = self.timeN if self.timeN is not None else self.time1
+        tgap = max(0.0, tresume - tlast)
+        nmiss = max(0, int(round(tgap / self.dt)) - 1)
+        self.gaps.append((k, nmiss, tgap))
+        self.gaptime += tgap
+        # Do not count the gap as an interval between frames
+        if self.timeN is not None:
+            self.timeN = tresume
+        
+    def finished(self):
+        "Were all the frames of a finite scan received?"
+        return not self.continuous and self.samplesread >= self.fps
+
+    def recv_view(self):
+        """
+        Memory where the next bytes received from the scanivalve should go.
+
+        Frames are stored back to back so a single `recv_into` may fill
+        several frames and a frame may be split across several calls. At most
+        `chunksize` bytes are requested at a time. In continuous mode the
+        view never crosses the end of the ring or the oldest unread frame.
+        If the ring is full, the view points to a scratch frame that will be
+        discarded.
+        """
+        packlen = self.packlen
+        if self.dropping:
+            return memoryview(self.scratch)[self.dropped:]
+        nb = self.nbytes
+        if not self.ring:
+            end = min(self.fps * packlen, nb + self.chunksize)
+            return self.flat[nb:end]
+        cap = len(self.flat)
+        free = (self.nread * packlen + cap) - nb
+        if free <= 0:
+            self.dropping = True
+            return memoryview(self.scratch)
+        pos = nb % cap
+        n = min(free, cap - pos, self.chunksize)
+        if not self.continuous:
+            n = min(n, self.fps * packlen - nb)
+        return self.flat[pos:pos + n]
+
+    def advance(self, n):
+        """
+        Commit `n` bytes received into the memory returned by `recv_view`.
+
+        Progress (`samplesread`) is only published for whole frames.
+        """
+        packlen = self.packlen
+        self.nrecv += 1
+        self.bytesrecv += n
+        self.scanbytes += n
+        if self.dropping:
+            self.dropped += n
+            if self.dropped == packlen:
+                self.overflow += 1
+                self.overflowtotal += 1
+                self.framesrecv += 1
+                self.dropped = 0
+                self.dropping = False
+            return
+        self.nbytes += n
+        if self.mmap is not None and self.nbytes - self.released >= self.releasesize:
+            self.release_pages()
+        k = self.nbytes // packlen
+        if self.validate and k > self.samplesread:
+            k = self.validate_frames(k)
+        if k > self.samplesread:
+            now = time.monotonic()
+            if self.samplesread == 0:
+                self.time2 = now
+                self.n2 = k
+                self.dataread = True
+            elif now - self.timeN > self.maxgap:
+                self.maxgap = now - self.timeN
+            self.timeN = now
+            k0 = self.samplesread
+            self.framesrecv += k - k0
+            self.samplesread = k
+            self.publish(k0, k)
+
+    def validate_frames(self, k1):
+        """
+        Checks the header of the frames received since the last call up to
+        frame `k1`. If a frame does not start with the expected header, the
+        stream lost its alignment: it is resynchronized (see `resync`).
+        Returns the number of whole frames after the check.
+        """
+        packlen = self.packlen
+        k0 = self.samplesread
+        if self.header is None and not self.find_header(k0):
+            return k0
+        while True:
+            k = self.check_frames(k0, k1)
+            if k == k1:
+                return k1
+            self.resync(k)
+            k0 = k
+            k1 = self.nbytes // packlen
+
+    def find_header(self, k0):
+        """
+        Learns the header of the frames (packet type and size) from the
+        bytes received from frame `k0` on. The size field must be the packet
+        length: if the first frame does not have it, the stream is searched
+        for a header repeated one packet later. Returns whether a header was
+        found (the frames before it are then resynchronized).
+        """
+        packlen = self.packlen
+        data = self.stream_bytes(k0 * packlen, self.nbytes)
+        size = np.array(packlen, '<i4').tobytes()
+        if data[4:8] == size:
+            self.header = data[:8]
+            return True
+        p = data.find(size, 5)
+        while p >= 0:
+            q = p - 4 + packlen
+            if len(data) >= q + 8 and data[q:q+8] == data[p-4:p+4]:
+                self.header = data[p-4:p+4]
+                return True
+            p = data.find(size, p + 1)
+        if len(data) >= min(64 * packlen, len(self.flat)):
+            raise RuntimeError("No frame with packet size {} received!".format(packlen))
+        return False
 
-        self.time2 = time.monotonic()
-        self.timeN = self.time2
-        self.dataread = True # There is data read
-        self.samplesread = 1
+    def check_frames(self, k0, k1):
+        "Index of the first frame from `k0` to `k1` with a bad header (`k1` if they are all fine)"
+        h = np.frombuffer(self.header, '<i8')[0]
+        segs = self.ring_segments(k0, k1) if self.ring else [self.buf[k0:k1]]
+        k = k0
+        for seg in segs:
+            # One 64 bit comparison per frame: packet type and size
+            bad = seg[:,:8].view('<i8')[:,0] != h
+            if bad.any():
+                return k + int(bad.argmax())
+            k += len(seg)
+        return k1
 
-        for i in range(1,fps):
-            if self.stop_reading:
-                print("STOP_READING")
+    def resync(self, k):
+        """
+        Frame `k` has a bad header. The bytes received from frame `k` on are
+        searched for the next header (confirmed by the header of the
+        following frame when it was already received), and the bytes before
+        it are discarded: the next frames are moved back to frame `k`.
+
+        Each resynchronization is recorded in `resyncs` as `(frame, byte
+        offset in the stream of the scan, bytes discarded)`.
+        """
+        packlen = self.packlen
+        start = k * packlen
+        data = self.stream_bytes(start, self.nbytes)
+        h = self.header
+        p = data.find(h, 1)
+        while p >= 0:
+            q = p + packlen
+            if len(data) < q + 8 or data[q:q+8] == h:
                 break
-            
-            s.recv_into(self.buf[i], self.packlen)
-            self.timeN = time.monotonic()
-            self.samplesread = i+1
+            p = data.find(h, p + 1)
+        if p < 0:
+            # No header yet: keep the last bytes, they might start one
+            p = len(data) - 7
+        self.put_bytes(start, data[p:])
+        self.nbytes = start + len(data) - p
+        if self.mmap is not None and not self.ring:
+            # Frames never received must stay zeroed in the file (see `load_frames`)
+            self.flat[self.nbytes:start+len(data)] = bytes(p)
+            self.released = min(self.released, start - start % mmap.PAGESIZE)
+        self.resyncs.append((k, self.scanbytes - len(data), p))
+        self.resynctotal += 1
+        self.bytesdiscarded += p
 
-        self.acquiring = False
+    def stream_bytes(self, start, end):
+        "Copy of the bytes `start` to `end` received in this scan (taking care of the ring)"
+        if not self.ring:
+            return bytes(self.flat[start:end])
+        cap = len(self.flat)
+        pos = start % cap
+        n1 = min(end - start, cap - pos)
+        return bytes(self.flat[pos:pos+n1]) + bytes(self.flat[:end-start-n1])
+
+    def put_bytes(self, start, data):
+        "Writes `data` at byte `start` of the stream of this scan (taking care of the ring)"
+        if not self.ring:
+            self.flat[start:start+len(data)] = data
+            return
+        cap = len(self.flat)
+        pos = start % cap
+        n1 = min(len(data), cap - pos)
+        self.flat[pos:pos+n1] = data[:n1]
+        self.flat[:len(data)-n1] = data[n1:]
+
+    def publish(self, k0, k1):
+        """
+        Called by the receive loop when frames `k0` to `k1` are complete.
+        Updates the channel statistics, if enabled, and runs the pipeline
+        stages.
+        """
+        if self.chanstats is None and not self.stages:
+            return
+        segs = self.ring_segments(k0, k1) if self.ring else [self.buf[k0:k1]]
+        for seg in segs:
+            P = seg.view(self.dtype)[:,0]['press']
+            if self.cal is not None:
+                P = self.decode(P, np.empty(P.shape))
+            if self.chanstats is not None:
+                self.chanstats.update(P)
+            for stage in self.stages:
+                stage.push(P)
+        if self.statsonly:
+            # The frames are not needed anymore
+            self.nread = k1
+
+    def drain(self, maxframes=None, dtype=np.float64, temp=False, tdecim=1, out=None):
+        """
+        Decode the frames of the ring buffer that were not consumed yet.
+
+        At most `maxframes` frames are returned. The frames are released
+        to the acquisition thread once they have been decoded. If `temp` is
+        true, a pair with pressure and temperature (averaged over blocks of
+        `tdecim` frames) is returned. If an array `out` is given, the
+        pressure is decoded into it (at most `len(out)` frames) and a
+        view of it is returned.
+        """
+        t0 = time.perf_counter()
+        k0 = self.nread
+        k1 = self.samplesread
+        if maxframes is not None:
+            k1 = min(k1, k0 + maxframes)
+        if out is not None:
+            k1 = min(k1, k0 + out.shape[0])
+            P = out[:k1-k0]
+        else:
+            P = np.empty((k1-k0, 16), dtype)
+        T = np.empty((k1-k0, 8), np.float32) if temp else None
+        i = 0
+        for seg in self.ring_segments(k0, k1):
+            fr = seg.view(self.dtype)[:,0]
+            self.decode(fr['press'], P[i:i+len(seg)])
+            if temp:
+                T[i:i+len(seg)] = fr['temp']
+            i += len(seg)
+        self.nread = k1
+        if temp:
+            T = block_mean(T, tdecim, dtype)
+        self.decoded(t0, k1 - k0)
+        if temp:
+            return P, T
+        return P
+
+    def decode(self, P, out):
+        "Writes the pressure `P` (view of the frames) into `out`, applying the calibration"
+        if self.cal is None:
+            out[...] = P
+        else:
+            self.cal.apply(P, out)
+        return out
+    
+    def decoded(self, t0, nframes):
+        "Accounts for the decoding of `nframes` frames started at `time.perf_counter()` `t0`"
+        self.decodetime += time.perf_counter() - t0
+        self.framesdecoded += nframes
+
+    def drain_raw(self, maxframes=None):
+        """
+        Same as `drain` but returns a copy of the raw frames, an array
+        with shape `(nframes, packlen)`.
+        """
+        k0 = self.nread
+        k1 = self.samplesread
+        if maxframes is not None:
+            k1 = min(k1, k0 + maxframes)
+        raw = np.concatenate(self.ring_segments(k0, k1))
+        self.nread = k1
+        return raw
+
+    def peek(self, k0=0, dtype=np.float64, copy=True):
+        """
+        Pressure of the frames from `k0` up to the last frame received,
+        while the acquisition goes on. Returns the pressure and the index of
+        the next frame, to be used as `k0` in the next call.
+
+        No lock is needed: frames already received are never modified while
+        acquiring a finite number of frames, so with `dtype=np.float32` and
+        `copy=False` a view into the buffer is returned. In continuous mode
+        the frames are copied and only those still in the ring buffer, and
+        out of reach of the `recv` in progress (`chunksize`), are
+        returned. They are not consumed (see `drain`).
+        """
+        k1 = self.samplesread
+        k0 = min(max(0, k0), k1)
+        if not self.continuous:
+            P = self.buf[k0:k1].view(self.dtype)[:,0]['press']
+            if self.cal is not None:
+                P = self.decode(P, np.empty(P.shape, dtype))
+            elif copy or np.dtype(dtype) != P.dtype:
+                P = P.astype(dtype)
+            return P, k1
+        nbuf = self.buf.shape[0]
+        packlen = self.packlen
+        # A recv in progress may be writing up to `chunksize` bytes past the
+        # last frame, into the slots of the oldest frames of the ring
+        margin = -(-self.chunksize // packlen)
+        k0 = min(k1, max(k0, k1 - nbuf + margin))
+        P = np.empty((k1-k0, 16), dtype)
+        i = 0
+        for seg in self.ring_segments(k0, k1):
+            self.decode(seg.view(self.dtype)[:,0]['press'], P[i:i+len(seg)])
+            i += len(seg)
+        # Frames that might have been overwritten while copying are discarded
+        first = -(-(self.nbytes + self.chunksize) // packlen) - nbuf
+        if first > k0:
+            P = P[first-k0:]
+        return P, k1
+
+    def ring_segments(self, k0, k1):
+        "Views of the raw frames `k0` to `k1` of the ring buffer (at most two pieces)"
+        nbuf = self.buf.shape[0]
+        n = k1 - k0
+        i0 = k0 % nbuf
+        n1 = min(n, nbuf - i0)
+        return [self.buf[i0:i0+n1], self.buf[:n-n1]]
         
-    def get_pressure(self):
+    def get_pressure(self, dtype=np.float64, copy=True, out=None):
         """
         Given a a buffer filled with frames, return the pressure 
+
+        The whole buffer is decoded in one pass through a structured view.
+        If `dtype` is `np.float32` and `copy` is `False`, a view into the
+        frame buffer is returned. This view is only valid until the next scan.
+        If there is a calibration (`cal`), it is applied in the same pass
+        and the pressure is always copied.
+
+        If an array `out` with at least `samplesread` rows is given, the
+        pressure is decoded into it (its dtype is used) and a view of its
+        first rows is returned: nothing is allocated.
         """
 
         if not self.dataread:
             raise RuntimeError("No pressure to read from scanivalve!")
-        nsamp = self.samplesread
-        P = np.zeros((nsamp, 16), np.float64)
-            
-        for i in range(nsamp):
-            np.copyto(P[i], self.buf[i,self.press].view(np.float32))
-                
+        if self.statsonly:
+            raise RuntimeError("Statistics only acquisition: frames were not stored!")
+        t0 = time.perf_counter()
+        P = self.frames()['press']
+        if out is not None:
+            if out.shape[0] < P.shape[0]:
+                raise RuntimeError("Output array too small for {} frames!".format(P.shape[0]))
+            P = self.decode(P, out[:P.shape[0]])
+        elif self.cal is not None:
+            P = self.decode(P, np.empty(P.shape, dtype))
+        elif copy or np.dtype(dtype) != P.dtype:
+            P = P.astype(dtype)
+        self.decoded(t0, P.shape[0])
         return P
+
+    def get_temperature(self, dtype=np.float64, copy=True, decim=1):
+        """
+        Return the temperature of the 8 temperature sensors.
+
+        Temperature changes slowly: with `decim` > 1, the temperatures are
+        averaged over blocks of `decim` frames. Same `dtype` and `copy`
+        semantics as `get_pressure`.
+        """
+        if not self.dataread:
+            raise RuntimeError("No temperature to read from scanivalve!")
+        t0 = time.perf_counter()
+        T = self.frames()['temp']
+        if decim > 1:
+            T = block_mean(T, decim, dtype)
+        elif copy or np.dtype(dtype) != T.dtype:
+            T = T.astype(dtype)
+        self.decodetime += time.perf_counter() - t0
+        return T
         
                           
     def get_time(self, meas=True):
@@ -126,49 +1201,161 @@ class Packet(object):
             
         nsamp = self.samplesread
         if meas:
-            if nsamp > 4:
-                return (self.timeN - self.time2) / (nsamp-1)
+            # Frames arrive in batches: time2 is when the first n2 frames arrived
+            if nsamp > 4 and nsamp > self.n2:
+                return (self.timeN - self.time2 - self.gaptime) / (nsamp-self.n2)
             elif nsamp > 0:
                 return (self.timeN - self.time1) / nsamp
                 
         if not self.t:
             return -1000.0
-        
-        ttype = self.buf[0,self.tunit].view(np.int32)[0]
-        tmult = 1e6 if ttype==1 else 1e3
-        t1 = self.buf[0,self.time].view(np.int32)[0]
-        t2 = self.buf[self.samplesread-1,104:108].view(np.int32)[0]
-        ns = max(1, self.samplesread-1)
-        dt = (t2 - t1) / (tmult * ns)
-        return self.dt
+        if nsamp < 2 or self.continuous:
+            return self.dt
+        t = self.get_timestamps()
+        return (t[-1] - t[0]) / (nsamp - 1)
+
+    def get_timestamps(self):
+        """
+        Time of each frame in seconds, measured by the scanivalve clock
+        (TIME field of the frames) from the first frame.
+
+        The 32 bit device counter is unwrapped, so long acquisitions are fine.
+        The device clock restarts when a scan is resumed: the estimated
+        duration of each gap (`gaps`) is used instead.
+        """
+        if not self.t:
+            raise RuntimeError("Frames have no time information. Use `tinfo=True`!")
+        if not self.dataread:
+            raise RuntimeError("No frames read from scanivalve!")
+        fr = self.frames()
+        # TIME is in μs if the unit is 1, in ms otherwise
+        tmult = 1e6 if fr['tunit'][0]==1 else 1e3
+        d = np.diff(fr['time'].astype(np.int64))
+        d = (d + 2**31) % 2**32 - 2**31
+        for k, nmiss, tgap in self.gaps:
+            if 0 < k < len(fr):
+                d[k-1] = round(tgap * tmult)
+        t = np.empty(len(fr), np.float64)
+        t[0] = 0.0
+        np.cumsum(d, out=t[1:])
+        t /= tmult
+        return t
         
     def clear(self):
         if self.acquiring is not False:
             raise RuntimeError("Still acquiring data from scanivalve!")
         self.acquiring = False
         self.samplesread = 0
+        self.nread = 0
+        self.overflow = 0
+        self.nbytes = 0
+        self.released = 0
+        self.dropped = 0
+        self.dropping = False
+        if self.chanstats is not None:
+            self.chanstats.reset()
         self.dataread = False
         self.time1 = None
         self.time2 = None
         self.timeN = None
+        self.n2 = 1
+        self.gaps = []
+        self.gaptime = 0.0
+        self.resyncs = []
+        self.scanbytes = 0
         self.stop_reading = False
+        self.clear_wakeup()
         
     def isacquiring(self):
         "Is the scanivalve acquiring data?"
         return self.acquiring
+
+    def add_stage(self, stage):
+        "Adds a pipeline stage (`DecimationStage`) run on the frames as they are received"
+        self.stages.append(stage)
+        return stage
+
+    def remove_stage(self, stage):
+        self.stages.remove(stage)
+        
+    def enable_stats(self, enable=True):
+        "Compute the channel statistics (`chanstats`) while frames are received"
+        if enable:
+            if self.chanstats is None:
+                self.chanstats = ChannelStats(16)
+        elif not self.statsonly:
+            self.chanstats = None
     
-    def read(self, meas=True):
-        "Read the data from the buffers and return a pair with pressure and sampling rate"
+    def read(self, meas=True, dtype=np.float64, copy=True, temp=False, tdecim=1, times=False,
+             out=None):
+        """
+        Read the data from the buffers and return a pair with pressure and sampling rate
+
+        If `temp` is true, the temperatures (averaged over blocks of
+        `tdecim` frames) are returned as a third element. If `times` is
+        true, the device timestamps of the frames (`get_timestamps`) are
+        returned last. The pressure is decoded into `out`, if given (see
+        `get_pressure`).
+        """
         if self.samplesread > 0:
-            p = self.get_pressure()
+            T = None
+            if self.continuous:
+                if times:
+                    raise RuntimeError("Timestamps are not available in continuous mode!")
+                p = self.drain(dtype=dtype, temp=temp, tdecim=tdecim, out=out)
+                if temp:
+                    p, T = p
+            else:
+                p = self.get_pressure(dtype, copy, out)
+                if temp:
+                    T = self.get_temperature(dtype, copy, tdecim)
             dt = self.get_time(meas)
-            return p, 1.0/dt
+            data = (p, 1.0/dt)
+            if temp:
+                data = data + (T,)
+            if times:
+                data = data + (self.get_timestamps(),)
+            return data
         else:
             raise RuntimeError("Nothing to read from scanivalve!")
     
     def stop(self):
+        "Stops the receive loop right away, even if it is waiting for data"
         self.stop_reading = True
+        try:
+            self.waker.send(b'x')
+        except BlockingIOError:
+            pass # Already woken up
         return None
+
+    def clear_wakeup(self):
+        try:
+            while self.wakeup.recv(64):
+                pass
+        except BlockingIOError:
+            pass
+
+    def close(self):
+        self.wakeup.close()
+        self.waker.close()
+        if self.mmap is not None:
+            self.flat = None
+            self.buf = None
+            self.close_mmap()
+
+    def stats(self):
+        """
+        Counters of the receive and decode paths. Only a few additions are
+        done per `recv` call, so they are always on.
+        """
+        return dict(scans=self.scans, scans_stopped=self.scansstopped, recv_calls=self.nrecv, bytes_received=self.bytesrecv,
+                    frames_received=self.framesrecv,
+                    bytes_per_recv=self.bytesrecv / max(1, self.nrecv),
+                    max_frame_gap=self.maxgap, overflow=self.overflow,
+                    overflow_total=self.overflowtotal, resyncs=self.resynctotal,
+                    bytes_discarded=self.bytesdiscarded, frames_decoded=self.framesdecoded,
+                    decode_time=self.decodetime,
+                    decode_ns_per_frame=1e9 * self.decodetime / max(1, self.framesdecoded))
         
  
     
@@ -177,18 +1364,48 @@ class ScanivalveThread(threading.Thread):
     Handles asynchronous threaded data acquisition.
 
     Objects of this class, handle the threading part of the acquisition
+
+    If the connection fails (timeout or closed socket), the `supervisor`
+    (usually the `Scanivalve` object) is asked to `recover`: if it returns a
+    new socket, the scan is resumed. Otherwise, and for any other exception
+    raised while receiving, the exception is kept in `error`.
     """
     
-    def __init__(self, s, dt, pack):
+    def __init__(self, s, dt, pack, barrier=None, supervisor=None):
         threading.Thread.__init__(self)
         self.pack = pack
         self.s = s
         self.dt = dt
+        self.barrier = barrier
+        self.supervisor = supervisor
+        self.error = None
         
 
     def run(self):
         self.pack.clear()
-        self.pack.scan(self.s, self.dt)
+        resume = False
+        while True:
+            try:
+                self.pack.scan(self.s, self.dt, self.barrier, resume)
+                break
+            except threading.BrokenBarrierError as e:
+                # Another module could not start
+                self.error = e
+                break
+            except OSError as e:
+                s = self.supervisor.recover(e) if self.supervisor is not None else None
+                if s is None:
+                    self.error = e
+                    break
+                self.s = s
+                self.barrier = None
+                resume = True
+            except Exception as e:
+                # Any other failure ends the acquisition, `read` reports it
+                self.error = e
+                break
+        if resume:
+            self.supervisor.resumed()
        
     def isacquiring(self):
         return self.pack.isacquiring()
@@ -212,24 +1429,22 @@ class Scanivalve(object):
     s = scanivalve.Scanivalve(ip)
     
     ```
+
+    The `port` can be changed to connect to a simulator (see `scanisim`).
     
     """
-    def __init__(self, ip='191.30.80.131', tinfo=False):
+    def __init__(self, ip='191.30.80.131', tinfo=False, port=23):
 
-        # Create the socket
-        
-        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.ip = ip
-        self.port = 23
+        self.port = port
 
         self.acquiring = False
-        self.s.settimeout(5)
-        # Connect to socket
-        try:
-            self.s.connect((self.ip,self.port))
-        except:
-            self.s = None
-            raise RuntimeError("Unable to connect to scanivalve on IP:{}!".format(ip))
+        self.replylines = {}
+        self.devstate = {}
+        self.cmdtimes = {}
+        self.cursor = 0
+        self.s = None
+        self.s = self.connect()
 
         # Clear errors and configure the scanivalve
         self.clear()
@@ -239,22 +1454,22 @@ class Scanivalve(object):
         self.PERIOD=500
         self.AVG=16
         self.XSCANTRIG = 0
+        self.ringsize = 65536
+        self.memmap = None
+        self.statsonly = False
+        self.resume = False
+        self.lastgaps = []
+        self.lastresyncs = []
+        self.retries = 5
+        self.backoff = 0.5
         
         self.time = 2 if tinfo else 0
         
-        self.set_var("BIN", 1)
-        self.set_var("EU", 1)
-        self.set_var("UNITSCAN", "PA")
-        self.set_var("XSCANTRIG", 0)
-        self.set_var("QPKTS", 0)
-        self.set_var("TIME", self.time)
-        self.set_var("SIM", 0)
-        self.set_var("AVG", self.AVG)
-        self.set_var("PERIOD", self.PERIOD)
-        self.set_var("FPS", self.FPS)
+        self.devstate = self.list_any_map('S')
+        self.set_vars(self.settings())
         self.dt = self.PERIOD*1e-6*16 * self.AVG
 
-        self.packet_info = self.packet_info()
+        self.packet_info = self.packet_info(self.time > 0)
 
         self.model = self.packet_info['model']
         
@@ -263,29 +1478,93 @@ class Scanivalve(object):
         self.pack.allocbuffer(self.FPS)
         self.thread = None
 
+    def connect(self, timeout=5):
+        "Opens a new connection to the scanivalve"
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(timeout)
+        # Large kernel buffer so that high frame rates survive short stalls of the reader
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+        # Commands are short: do not let Nagle's algorithm hold them back
+        s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            s.connect((self.ip,self.port))
+        except OSError:
+            s.close()
+            raise RuntimeError("Unable to connect to scanivalve on IP:{}!".format(self.ip))
+        return s
+
+    def settings(self):
+        "Device configuration as a list of `(var, val)`, from the cached acquisition parameters"
+        return [("BIN", 1), ("EU", 1), ("UNITSCAN", "PA"), ("XSCANTRIG", self.XSCANTRIG),
+                ("QPKTS", 0), ("TIME", self.time), ("SIM", 0),
+                ("AVG", self.AVG), ("PERIOD", self.PERIOD), ("FPS", self.FPS)]
+
+    def reconnect(self, retries=5, backoff=0.5, maxbackoff=8.0):
+        """
+        Replaces a dead connection: connects again (at most `retries`
+        attempts, waiting `backoff` seconds after the first failure and
+        doubling up to `maxbackoff`), stops any scan still running on the
+        device and applies the last configuration.
+        """
+        if self.s is not None:
+            self.s.close()
+            self.s = None
+        wait = backoff
+        for i in range(retries):
+            try:
+                self.s = self.connect()
+                break
+            except RuntimeError:
+                if i == retries - 1:
+                    raise
+                time.sleep(wait)
+                wait = min(2*wait, maxbackoff)
+        self.s.sendall(b"STOP\n")
+        # Frames of the old scan
+        while self.is_pending(0.05):
+            if not self.s.recv(65536):
+                raise ConnectionError("Scanivalve closed the connection!")
+        self.acquiring = False
+        self.clear()
+        self.devstate = self.list_any_map('S')
+        self.set_vars(self.settings())
+        
+    def recover(self, error):
+        """
+        Called by the acquisition thread when the connection fails. If
+        `RESUME` is configured, reconnects and returns the new socket so
+        that the scan resumes: the frames missed are recorded in
+        `Packet.gaps`. Finite acquisitions only ask for the frames still
+        missing. Returns `None` if the acquisition should end.
+        """
+        if not self.resume or self.pack.stop_reading:
+            return None
+        try:
+            self.reconnect(self.retries, self.backoff)
+            if not self.pack.continuous:
+                self.set_vars([("FPS", self.FPS - self.pack.samplesread)])
+        except Exception:
+            return None
+        finally:
+            self.acquiring = True
+        self.pack.mark_gap(time.monotonic())
+        return self.s
+
+    def resumed(self):
+        "End of an acquisition that was resumed: restores the number of frames"
+        if self.pack.continuous or self.s is None:
+            return
+        self.acquiring = False
+        try:
+            self.set_vars([("FPS", self.FPS)])
+        except Exception:
+            pass
+        finally:
+            self.acquiring = True
+        
     def packet_info(self, tinfo=True):
         model = self.get_model().strip()
-        if model=='3017':
-            tinfo = False
-            packlen = 104
-            tt = None
-            tunit = None
-        elif model=='3217':
-            press = slice(8, 72)
-            temp = slice(72,104)
-            if tinfo:
-                packlen = 112
-                tt = slice(104, 108)
-                tunit = slice(108, 112)
-                
-            else:
-                packlen = 104
-                tt = None
-                tunit =  None
-        else:
-            raise RuntimeError("Model {} not recognized!".format(model))
-        
-        return dict(model=model, packlen=packlen, press=press, temp=temp, t=tinfo, time=tt, tunit=tunit)
+        return packet_layout(model, tinfo)
             
         
 
@@ -299,6 +1578,36 @@ class Scanivalve(object):
         else:
             return True
 
+    def read_reply(self, command=None, timeout=0.5, gap=0.02):
+        """
+        Reads the reply to a command.
+
+        Waits at most `timeout` seconds for the reply to start. The reply is
+        over when the prompt arrives, when it has as many lines as the last
+        reply to the same `command` or when it ends at a line boundary and
+        nothing else arrives for `gap` seconds.
+        """
+        buffer = bytearray()
+        nlines = self.replylines.get(command)
+        wait = timeout
+        while self.is_pending(wait):
+            chunk = self.s.recv(4096)
+            if not chunk:
+                break
+            buffer += chunk
+            status = reply_status(buffer, nlines)
+            if status == REPLY_DONE:
+                if self.is_pending(0):
+                    # Longer than the last reply
+                    nlines = None
+                    wait = gap
+                    continue
+                break
+            wait = gap if status == REPLY_LINE else timeout
+        if command is not None and buffer:
+            self.replylines[command] = buffer.count(b'\r\n')
+        return bytes(buffer)
+        
     def list_any(self, command, timeout=0.2):
         """
         Most query commands of the DSA-3X17 consists of
@@ -310,38 +1619,125 @@ class Scanivalve(object):
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
 
-        cmd = ("LIST %s\n" % (command)).encode()
-
-        self.s.send(cmd)
-
-        buffer = b''
-        
-        while self.is_pending(timeout):
-            buffer = buffer + self.s.recv(1492)
-            
-        return [b.split(' ') for b in  buffer.decode().strip().split('\r\n')]
+        cmd = ("LIST %s\n" % (command)).encode()
+
+        t0 = time.perf_counter()
+        self.s.send(cmd)
+
+        buffer = self.read_reply(cmd, timeout)
+        self.timed("LIST " + command, t0)
+            
+        return parse_list(buffer)
+
+    def timed(self, command, t0):
+        "Records the round trip of `command` started at `time.perf_counter()` `t0`"
+        dt = time.perf_counter() - t0
+        n, total, dtmax = self.cmdtimes.get(command, (0, 0.0, 0.0))
+        self.cmdtimes[command] = (n + 1, total + dt, max(dtmax, dt))
+
+    def list_any_map(self, command, timeout=0.5):
+        """
+        Takes data obtained from `list_any` method and builds a dictionary with the
+        different parameters
+        """
+
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+
+        buffer = self.list_any(command, timeout)
+        list = {}
+        for i in range(len(buffer)):
+            if len(buffer[i]) >= 3:
+                list[buffer[i][1]] = buffer[i][2]
+        return list
+
+    def hard_zero(self, wait=False, timeout=30.0, poll=0.1):
+        """
+        Command to zero the DSA-3X17
+
+        With `wait=True`, returns when the scanivalve is done (see
+        `zeroing`). A `RuntimeError` is raised after `timeout` seconds.
+        """
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+
+        self.s.send(b"CALZ\n")
+        if wait:
+            t1 = time.monotonic() + timeout
+            while self.zeroing():
+                if time.monotonic() > t1:
+                    raise RuntimeError("Scanivalve zero (CALZ) did not finish in {} s!".format(timeout))
+                time.sleep(poll)
+
+    def status(self):
+        """
+        State of the scanivalve (STATUS command), such as 'READY', 'SCAN'
+        or 'CALZ'. An empty string if it did not answer.
+        """
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        t0 = time.perf_counter()
+        self.s.send(b"STATUS\n")
+        buffer = self.read_reply(b"STATUS\n")
+        self.timed("STATUS", t0)
+        words = parse_list(buffer)[-1]
+        return words[-1].upper()
+
+    def zeroing(self):
+        "Is the zero calibration (CALZ) still running? A busy scanivalve might not answer"
+        return self.status() in ('CALZ', '')
 
-    def list_any_map(self, command, timeout=0.5):
-        """
-        Takes data obtained from `list_any` method and builds a dictionary with the
-        different parameters
-        """
+    def serial(self):
+        "Serial number of the module (LIST I)"
+        return self.list_any_map('I').get('SN', '')
 
+    def set_calibration(self, cal):
+        "Software calibration (`Calibration`) applied when the pressure is decoded. `None` to remove it"
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        self.pack.cal = cal
 
-        buffer = self.list_any(command, timeout)
-        list = {}
-        for i in range(len(buffer)):
-            list[buffer[i][1]] = buffer[i][2]
-        return list
+    def calibration(self):
+        return self.pack.cal
 
-    def hard_zero(self):
-        "Command to zero the DSA-3X17"
+    def zero_offsets(self, nframes=64, save=True, filename=CALFILE):
+        """
+        Software zero: acquires `nframes` frames (the pressure should be
+        zero on every channel) and uses their mean as the offsets of the
+        calibration, keeping the gains. The calibration is saved under the
+        serial number of the module if `save` is true.
+        """
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        # Separate buffer: the configured one (MEMMAP file, STATSONLY) is left alone
+        pk = Packet(self.packet_info)
+        pk.header = self.pack.header
+        pk.xtrig = self.pack.xtrig
+        pk.allocbuffer(nframes)
+        try:
+            self.set_vars([("FPS", nframes)])
+            pk.scan(self.s, self.dt)
+            p, freq = pk.read(dtype=np.float64)
+        finally:
+            pk.close()
+            self.set_vars([("FPS", self.FPS)])
+        cal = self.pack.cal
+        if cal is None:
+            cal = Calibration(serial=self.serial())
+        cal.offset = p.mean(0)
+        cal.time = time.strftime('%Y-%m-%dT%H:%M:%S')
+        if cal.serial is None:
+            cal.serial = self.serial()
+        self.pack.cal = cal
+        if save:
+            save_calibration(cal, filename)
+        return cal
 
-        self.s.send(b"CALZ\n")
+    def load_calibration(self, filename=CALFILE):
+        "Applies the calibration saved for this module, if any. Returns it"
+        cal = load_calibration(self.serial(), filename)
+        self.set_calibration(cal)
+        return cal
         
     
 
@@ -355,6 +1751,36 @@ class Scanivalve(object):
 
         cmd = ( "SET %s %s\n" % (var, val) ).encode()
         self.s.send(cmd)
+        # Not verified: the next transaction will send it again
+        self.devstate.pop(var.upper(), None)
+
+    def set_vars(self, settings, verify=True):
+        """
+        Sets several parameters in a single transaction.
+
+        `settings` is a dictionary or a list of `(var, val)` pairs. The
+        parameters already known to have the requested value (cached copy
+        of `LIST S`) are skipped and the others are sent in one write. If
+        `verify` is true, the configuration is read back once and a
+        `RuntimeError` is raised if the device did not apply it.
+
+        Returns the list of parameters that were sent.
+        """
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        pending = pending_settings(settings, self.devstate)
+        if not pending:
+            return []
+        cmd = ''.join("SET %s %s\n" % (var, val) for var, val in pending).encode()
+        t0 = time.perf_counter()
+        self.s.sendall(cmd)
+        if verify:
+            self.devstate = self.list_any_map('S')
+            check_settings(pending, self.devstate)
+        else:
+            self.devstate.update((var, str(val)) for var, val in pending)
+        self.timed("SET", t0)
+        return [var for var, val in pending]
 
     def get_model(self):
         """
@@ -364,21 +1790,37 @@ class Scanivalve(object):
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
         return self.list_any_map("I")["MODEL"]
         
-    def stop(self):
+    def stop(self, timeout=1.0):
         """
         Stop the scanivalve
+
+        The acquisition thread is woken up at once and the frames sent
+        after the STOP command are discarded until the scanivalve is quiet.
+        Takes a few ms; `timeout` bounds the wait in any case.
         """
-        self.pack.stop_reading = True
+        t1 = time.monotonic() + timeout
+        self.pack.stop()
+        self.s.sendall(b"STOP\n")
+        if self.thread is not None:
+            self.thread.join(timeout)
         self.pack.acquiring = False
-        self.s.send(b"STOP\n")
-            
         self.acquiring = False
         self.thread = None
-        time.sleep(0.2)
-        buffer = b''
-        while self.is_pending(0.5):
-            buffer = buffer + self.s.recv(1492)
+        self.drain_input(t1)
+        if self.pack.continuous:
+            self.clear_drained()
         return None
+
+    def clear_drained(self):
+        "Clears the ring buffer of a continuous acquisition that ended once every frame was read"
+        if not self.pack.acquiring and self.pack.nread >= self.pack.samplesread:
+            self.pack.clear()
+
+    def drain_input(self, tmax, gap=0.02):
+        "Discards whatever the scanivalve sends until it is quiet for `gap` seconds or time `tmax`"
+        while time.monotonic() < tmax and self.is_pending(gap):
+            if not self.s.recv(65536):
+                break
     def clear(self):
         """
         Clear the error buffer in the scanivalve
@@ -394,14 +1836,12 @@ class Scanivalve(object):
         """
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        t0 = time.perf_counter()
         self.s.send(b"ERROR\n")
 
-        buffer = b''
-        
-        while self.is_pending(1):
-            buffer = buffer + self.s.recv(1492)
+        buffer = self.read_reply(timeout=1)
+        self.timed("ERROR", t0)
         return buffer
-        return buffer.strip().split('\r\n')
     
         
         
@@ -429,70 +1869,258 @@ class Scanivalve(object):
         self.set_var("AVG", self.AVG)
         self.set_var("PERIOD", self.PERIOD)
         self.set_var("XSCANTRIG", XSCANTRIG)
+        self.XSCANTRIG = XSCANTRIG
+        self.pack.xtrig = bool(XSCANTRIG)
     def config(self, **kw):
         """
         Configures data aquisition 
         """
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
-        isold = self.model=='3017'
+        realloc = False
+        settings = []
+        old = (self.FPS, self.memmap, self.statsonly)
         for k in kw.keys():
             K = k.upper()
-            if K == 'XSCANTRIG':
-                val = int(kw[k])
-                self.XSCANTRIG = val
-            elif K=='PERIOD':
-                x = int(kw[k])
-                val = clamp(x, 500, 62500)  if isold else clamp(x, 160, 650000)
-                self.PERIOD = val
-            elif K=='AVG':
-                x = int(kw[k])
-                val = clamp(x, 1, 32767) if isold else clamp(x, 1, 240)
-                self.AVG = val
-            elif K=='FPS':
-                x = int(kw[k])
-                val = clamp(x, 1, 2**31) if isold else clamp(x, 1, 2**30)
-                self.FPS = val
-                self.pack.allocbuffer(self.FPS)
-            else:
-                RuntimeError("Illegal configuration. SET {} {} not implemented!".format(K, kw[k]))
-
-            self.set_var(K, val)
+            if K=='RINGSIZE':
+                # Size of the ring buffer in frames used when FPS=0. Not a device parameter
+                self.ringsize = max(1, int(kw[k]))
+                realloc = True
+                continue
+            if K=='MEMMAP':
+                # File backing the frame buffer (None: memory). Not a device parameter
+                self.memmap = kw[k]
+                realloc = True
+                continue
+            if K=='STATS':
+                # Channel statistics computed during the acquisition. Not a device parameter
+                self.pack.enable_stats(bool(kw[k]))
+                continue
+            if K=='RESUME':
+                # Reconnect and resume the acquisition if the connection fails
+                self.resume = bool(kw[k])
+                continue
+            if K=='STATSONLY':
+                # Only the channel statistics are kept, frames are not stored
+                if bool(kw[k]) != self.statsonly:
+                    self.statsonly = bool(kw[k])
+                    realloc = True
+                continue
+            val = config_value(self.model, K, kw[k])
+            setattr(self, K, val)
+            if K=='FPS':
+                realloc = True
+            settings.append((K, val))
+        if self.memmap is not None and self.FPS == 0 and not self.statsonly:
+            self.FPS, self.memmap, self.statsonly = old
+            raise RuntimeError("MEMMAP needs a finite acquisition (FPS > 0)!")
+        self.set_vars(settings)
+        self.pack.xtrig = bool(self.XSCANTRIG)
 
+        if realloc:
+            self.pack.allocbuffer(self.FPS, self.ringsize, self.memmap, self.statsonly)
         self.dt = self.PERIOD*1e-6*16 * self.AVG
         
         
-    def acquire(self):
+    def acquire(self, dtype=np.float64, copy=True, temp=False, tdecim=1, times=False, out=None):
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        if self.pack.continuous:
+            raise RuntimeError("acquire needs a finite number of frames (FPS > 0)!")
+        # Leftovers of a previous (stopped) acquisition
+        self.pack.clear()
         self.pack.scan(self.s, self.dt)
-        p,freq = self.pack.read()
+        self.lastgaps = list(self.pack.gaps)
+        self.lastresyncs = list(self.pack.resyncs)
+        data = self.pack.read(dtype=dtype, copy=copy, temp=temp, tdecim=tdecim, times=times,
+                              out=out)
         self.pack.clear()
-        return p, freq
+        return data
     
-    def start(self):
+    def pipeline(self, nbuf=2):
+        "Queue of back to back acquisitions with `nbuf` buffers (see `AcquisitionQueue`)"
+        return AcquisitionQueue(self, nbuf)
+
+    def start(self, barrier=None):
         if self.acquiring:
             raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
-        self.thread = ScanivalveThread(self.s, self.dt, self.pack)
+        self.cursor = 0
+        self.thread = ScanivalveThread(self.s, self.dt, self.pack, barrier, self)
         self.thread.start()
         self.acquiring = True
         
         
-    def read(self):
+    def read(self, dtype=np.float64, copy=True, temp=False, tdecim=1, times=False, out=None):
+        """
+        Waits for the end of the acquisition and returns the pressure and
+        the sampling rate. With `temp=True`, the temperatures (averaged
+        over blocks of `tdecim` frames) are returned as well. With
+        `times=True` the device timestamps of each frame are returned last
+        (needs `tinfo=True`).
+
+        The pressure is decoded into the array `out`, if given, and a view
+        of its first rows is returned: test matrices with many short
+        acquisitions can reuse the same array (the frame buffer is reused
+        as well, see `Packet.getbuffer`).
+
+        If the acquisition failed, the frames received before the failure
+        are returned first and the error is raised once they are all read.
+        """
+        if self.pack.statsonly:
+            raise RuntimeError("Statistics only acquisition: frames were not stored. Use read_stats!")
+        if self.pack.continuous:
+            # Continuous scan: return the frames not read yet without waiting
+            th = self.thread
+            failed = th is not None and not th.is_alive() and th.error is not None
+            if failed and self.pack.nread >= self.pack.samplesread:
+                # Every frame received before the failure was read
+                self.thread = None
+                self.acquiring = False
+                self.pack.clear()
+                raise RuntimeError("Acquisition failed: {}".format(th.error)) from th.error
+            data = self.pack.read(dtype=dtype, temp=temp, tdecim=tdecim, out=out)
+            if th is not None and not th.is_alive() and not failed:
+                self.thread = None
+                self.acquiring = False
+            if self.thread is None:
+                self.clear_drained()
+            return data
         
+        error = None
         if self.thread is not None:
             self.thread.join()
+            error = self.thread.error
 
         if self.pack.samplesread > 0:
-            p, freq = self.pack.read()
-            self.pack.clear()
+            # After an error, the frames received so far
+            self.lastgaps = list(self.pack.gaps)
+            self.lastresyncs = list(self.pack.resyncs)
+            try:
+                return self.pack.read(dtype=dtype, copy=copy, temp=temp, tdecim=tdecim,
+                                      times=times, out=out)
+            finally:
+                self.pack.clear()
+                self.thread = None
+                self.acquiring = False
+        elif error is not None:
             self.thread = None
             self.acquiring = False
-            return p, freq
+            raise RuntimeError("Acquisition failed: {}".format(error)) from error
         else:
-            #raise RuntimeError("Nothing to read")
-            print("ERRO EM READ")
+            raise RuntimeError("Nothing to read from scanivalve!")
+        
+    def read_stats(self):
+        """
+        Waits for the end of the acquisition and returns the channel
+        statistics (`ChannelStats`) and the sampling rate. Needs the
+        `STATS` or `STATSONLY` configuration.
+        """
+        if self.pack.chanstats is None:
+            raise RuntimeError("Channel statistics not enabled. Use config(STATS=True)!")
+        if self.thread is not None and not self.pack.continuous:
+            self.thread.join()
+        if self.pack.samplesread == 0:
+            raise RuntimeError("Nothing to read from scanivalve!")
+        stats = self.pack.chanstats.copy()
+        freq = 1.0 / self.pack.get_time(True)
+        if not self.pack.continuous:
+            self.pack.clear()
+            self.thread = None
+            self.acquiring = False
+        return stats, freq
+
+    def gaps(self):
+        """
+        Gaps `(frame, missing frames, seconds)` of the acquisition that was
+        resumed after a connection failure (`RESUME=True`). After `read`,
+        the gaps of the last acquisition.
+        """
+        return list(self.pack.gaps) if self.thread is not None else self.lastgaps
+
+    def resyncs(self):
+        """
+        Places where the frame stream lost its alignment and was
+        resynchronized: `(frame, byte offset, bytes discarded)` (see
+        `Packet.resync`). After `read`, those of the last acquisition.
+        """
+        return list(self.pack.resyncs) if self.thread is not None else self.lastresyncs
         
+    def chanstats(self):
+        "Channel statistics of the frames received so far (while acquiring)"
+        return self.pack.chanstats
+
+    def add_stage(self, stage):
+        """
+        Adds a decimation stage run on the frames while they are received.
+
+        ```python
+        s.config(FPS=100000, PERIOD=10, AVG=1)
+        slow = s.add_stage(scanivalve.BlockMean(100))
+        s.start()
+        p, freq = s.read()           # 100000 frames
+        pslow, fslow = s.read_stage(slow) # 1000 frames
+        ```
+        With `STATSONLY=True`, only the decimated frames are kept.
+        """
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        return self.pack.add_stage(stage)
+
+    def remove_stage(self, stage):
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        self.pack.remove_stage(stage)
+
+    def read_stage(self, stage, dtype=np.float64):
+        """
+        Output of a decimation stage since the last call and its sampling
+        rate. Can be called during the acquisition.
+        """
+        return stage.read(dtype), 1.0 / (self.dt * stage.n)
+    
+    def drain(self, maxframes=None, dtype=np.float64, temp=False, tdecim=1):
+        """
+        Returns the pressure frames acquired in continuous mode (FPS=0)
+        since the last call. The scanivalve keeps scanning.
+        """
+        if not self.pack.continuous:
+            raise RuntimeError("Scanivalve is not configured for continuous acquisition (FPS=0)!")
+        return self.pack.drain(maxframes, dtype, temp, tdecim)
+
+    def overflow(self):
+        "Number of frames discarded because the ring buffer was full"
+        return self.pack.overflow
+
+    def peek(self, since=None, dtype=np.float64, copy=True):
+        """
+        Returns the pressure frames received since the last call to `peek`
+        (or since frame `since`) while the acquisition goes on. The
+        acquisition thread is not interrupted or locked.
+
+        ```python
+        s.start()
+        while s.isacquiring():
+            p = s.peek()   # Only the new frames
+            plot(p)
+        ```
+        """
+        if since is None:
+            since = self.cursor
+        p, self.cursor = self.pack.peek(since, dtype, copy)
+        return p
+
+    def last(self, nframes, dtype=np.float64):
+        "Returns the last `nframes` frames received, while the acquisition goes on."
+        p, k = self.pack.peek(self.pack.samplesread - nframes, dtype)
+        return p
+
+    def timing(self):
+        """
+        Timing statistics (see `timing_stats`) of the frames read so far,
+        based on the device timestamps. Needs `tinfo=True`.
+        """
+        return timing_stats(self.pack.get_timestamps())
+    
     def samplesread(self):
         if self.thread is not None:
             return self.pack.samplesread
@@ -509,16 +2137,39 @@ class Scanivalve(object):
         
     def isacquiring(self):
         if self.thread is not None:
-            return self.pack.isacquring()
+            return self.thread.is_alive()
         else:
             raise RuntimeError("Scanivalve not reading")
         
+    def stats(self):
+        """
+        Counters of the acquisition (see `Packet.stats`) and the round
+        trip of the commands: for each command, the number of calls and
+        the mean and maximum time in seconds.
+        """
+        st = self.pack.stats()
+        st['commands'] = {cmd: dict(count=n, mean=total/n, max=dtmax)
+                          for cmd, (n, total, dtmax) in self.cmdtimes.items()}
+        return st
+
+    def metrics_text(self, prefix='scanivalve'):
+        "`stats` in the Prometheus text exposition format"
+        return prometheus_text(self.stats(), prefix, dict(ip=self.ip))
+
+    def monitor(self, fun):
+        "Calls `fun(stats)` from the acquisition thread at the end of every scan (`None` to disable)"
+        if fun is None:
+            self.pack.onscan = None
+        else:
+            self.pack.onscan = lambda st: fun(self.stats())
+            
     def close(self):
         if self.acquiring:
             self.stop()
         self.thread = None
         self.s.close()
         self.s = None
+        self.pack.close()
 
     def nchans(self):
         return 16
@@ -533,9 +2184,676 @@ class Scanivalve(object):
         conf = dict(devtype='pressure', manufacturer='scanivalve', model=self.model,
                     parameters=self.list_any_map('S'))
         return conf
+
+    def capture_info(self):
+        """
+        Metadata describing the current acquisition: model, packet layout,
+        acquisition parameters and the `list_config` snapshot.
+        """
+        return dict(model=self.model, ip=self.ip, packlen=self.pack.packlen, t=bool(self.pack.t),
+                    FPS=self.FPS, AVG=self.AVG, PERIOD=self.PERIOD, XSCANTRIG=self.XSCANTRIG,
+                    dt=self.dt, channels=self.channames(), config=self.list_config())
+
+
+class AcquisitionQueue(object):
+    """
+    Pipelined acquisition of back to back test points.
+
+    `nbuf` frame buffers (`Packet`) are used in turn: a worker thread
+    starts the next acquisition as soon as the previous one ended and a
+    buffer is free, while the frames of the previous points are decoded
+    by `get`. A sequence of M points takes about M times the scan time.
+
+    ```python
+    s.config(FPS=10000)
+    with s.pipeline(nbuf=2) as q:
+        for p, freq in q.acquire(100):
+            ...
+    ```
+
+    While the queue is open, `scani.pack` is the buffer being filled (so
+    `stop` and `RESUME` act on the current acquisition) and the
+    `Scanivalve` cannot be configured. Finite acquisitions only
+    (FPS > 0), frames in memory and no pipeline stages (`add_stage`).
+    """
+    def __init__(self, scani, nbuf=2):
+        if scani.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        if scani.pack.continuous or scani.statsonly or scani.memmap is not None:
+            raise RuntimeError("Pipelined acquisition needs FPS > 0 and frames in memory!")
+        if scani.pack.stages:
+            # Their output would be cleared by the next point before being read
+            raise RuntimeError("Pipeline stages are not supported by the acquisition queue!")
+        self.scani = scani
+        self.pack0 = scani.pack
+        self.packs = [scani.pack] + [self.new_packet() for i in range(nbuf-1)]
+        self.free = queue.Queue()
+        for pk in self.packs:
+            self.free.put(pk)
+        self.todo = queue.Queue()
+        self.done = queue.Queue()
+        self.pending = 0
+        self.closing = False
+        scani.acquiring = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def new_packet(self):
+        "Buffer configured like the one of the `Scanivalve`"
+        p0 = self.pack0
+        pk = Packet(self.scani.packet_info)
+        pk.allocbuffer(self.scani.FPS)
+        if p0.chanstats is not None:
+            pk.enable_stats()
+        pk.cal = p0.cal
+        pk.validate = p0.validate
+        pk.header = p0.header
+        pk.xtrig = p0.xtrig
+        pk.chunksize = p0.chunksize
+        return pk
+
+    def submit(self, npoints=1):
+        "Queues `npoints` acquisitions. Returns right away"
+        if self.closing:
+            raise RuntimeError("Acquisition queue closed!")
+        for i in range(npoints):
+            self.pending += 1
+            self.todo.put(True)
+
+    def run(self):
+        "Worker thread: one acquisition per request, each into a free buffer"
+        scani = self.scani
+        while True:
+            if self.todo.get() is None:
+                break
+            pk = self.free.get()
+            if pk is None:
+                break
+            scani.pack = pk
+            th = ScanivalveThread(scani.s, scani.dt, pk, None, scani)
+            th.run()
+            self.done.put((pk, th.error))
+
+    def get(self, dtype=np.float64, temp=False, tdecim=1, times=False, out=None):
+        """
+        Waits for the oldest acquisition not read yet and returns the same
+        as `Scanivalve.read`. The pressure is always copied (or decoded
+        into `out`): the buffer is handed back to the worker right away.
+        """
+        if self.pending == 0:
+            raise RuntimeError("No acquisition queued!")
+        pk, error = self.done.get()
+        self.pending -= 1
+        try:
+            if pk.samplesread == 0:
+                raise RuntimeError("Acquisition failed: {}".format(error)) from error
+            data = pk.read(dtype=dtype, temp=temp, tdecim=tdecim, times=times, out=out)
+            # See `Scanivalve.gaps` and `Scanivalve.resyncs`
+            self.scani.lastgaps = list(pk.gaps)
+            self.scani.lastresyncs = list(pk.resyncs)
+        finally:
+            pk.clear()
+            self.free.put(pk)
+        return data
+
+    def acquire(self, npoints, **kw):
+        "Generator of the result of `npoints` acquisitions (keywords of `get`)"
+        self.submit(npoints)
+        for i in range(npoints):
+            yield self.get(**kw)
+
+    def close(self):
+        """
+        Stops the queue: the acquisition under way is stopped, the points
+        not started are dropped and so are the results not read yet.
+        """
+        if self.closing:
+            return
+        self.closing = True
+        scani = self.scani
+        try:
+            while True:
+                self.todo.get_nowait()
+        except queue.Empty:
+            pass
+        self.todo.put(None)
+        self.free.put(None)
+        stopped = False
+        while self.thread.is_alive():
+            # The worker might be starting an acquisition it took before
+            pk = scani.pack
+            if pk.acquiring and not pk.stop_reading:
+                pk.stop()
+                scani.s.sendall(b"STOP\n")
+                stopped = True
+            self.thread.join(0.05)
+        if stopped:
+            scani.drain_input(time.monotonic() + 1.0)
+        for pk in self.packs:
+            pk.acquiring = False
+            pk.clear()
+            if pk is not self.pack0:
+                pk.close()
+        scani.pack = self.pack0
+        scani.acquiring = False
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class ScanivalveArray(object):
+    """
+    # Synchronized acquisition from several DSA modules
+
+    Configures N modules in parallel and starts them together. Each module
+    is read by its own thread and the data is merged into a single array
+    with 16*N channels.
+
+    ```python
+    import scanivalve
+
+    a = scanivalve.ScanivalveArray([ip1, ip2, ip3])
+    a.config(FPS=1000, AVG=16)
+    a.start()
+    p, freq = a.read()
+    print(a.skew())
+    ```
+
+    If `XSCANTRIG=1` is configured, every module waits for the external
+    trigger after SCAN and the start skew is set by the hardware.
+    """
+    def __init__(self, ips, tinfo=False):
+        self.ips = list(ips)
+        self.tstart = None
+        self.tfirst = None
+        def connect(ip):
+            try:
+                if isinstance(ip, tuple):
+                    # (ip, port)
+                    return Scanivalve(ip[0], tinfo, ip[1])
+                return Scanivalve(ip, tinfo)
+            except Exception as e:
+                return e
+        modules = self.parallel(connect, self.ips)
+        self.modules = [m for m in modules if isinstance(m, Scanivalve)]
+        errors = [m for m in modules if not isinstance(m, Scanivalve)]
+        if errors:
+            self.close()
+            raise errors[0]
+        self.model = [m.model for m in self.modules]
+        
+    def parallel(self, fun, args=None):
+        """
+        Calls `fun` for every module (or every element of `args`) at the same time.
+        Returns the list of results. The first exception is raised again.
+        """
+        if args is None:
+            args = self.modules
+        args = list(args)
+        results = [None]*len(args)
+        errors = [None]*len(args)
+        def run(i):
+            try:
+                results[i] = fun(args[i])
+            except Exception as e:
+                errors[i] = e
+        threads = [threading.Thread(target=run, args=(i,)) for i in range(len(args))]
+        for th in threads:
+            th.start()
+        for th in threads:
+            th.join()
+        for i in range(len(args)):
+            if errors[i] is not None:
+                raise errors[i]
+        return results
+
+    def nmodules(self):
+        return len(self.modules)
+    
+    def config(self, **kw):
+        "Configures every module in parallel. Same keywords as `Scanivalve.config`"
+        self.parallel(lambda m: m.config(**kw))
     
+    def list_config(self):
+        return self.parallel(lambda m: m.list_config())
+
+    def hard_zero(self, wait=False, timeout=30.0):
+        self.parallel(lambda m: m.hard_zero(wait, timeout))
         
+    def start(self, timeout=10.0):
+        """
+        Starts every module. The SCAN commands are sent by all the
+        acquisition threads once every one of them is ready (at most
+        `timeout` seconds). If a module cannot start, none of them scans.
+        """
+        for m in self.modules:
+            if m.acquiring:
+                raise RuntimeError("Illegal operation. Scanivalve {} is currently acquiring data!".format(m.ip))
+        barrier = threading.Barrier(len(self.modules), timeout=timeout)
+        started = []
+        try:
+            for m in self.modules:
+                m.start(barrier)
+                started.append(m)
+        except Exception:
+            # The threads already started are waiting for the others
+            barrier.abort()
+            self.reset(started)
+            raise
+
+    def reset(self, modules=None):
+        "Waits for the acquisition threads and leaves the modules idle. Frames are discarded"
+        for m in self.modules if modules is None else modules:
+            if m.thread is not None:
+                m.thread.join()
+            m.pack.acquiring = False
+            m.pack.clear()
+            m.thread = None
+            m.acquiring = False
+
+    def samplesread(self):
+        return min(m.samplesread() for m in self.modules)
+
+    def read(self, dtype=np.float64, out=None):
+        """
+        Waits for every module and returns the merged pressure with shape
+        `(nsamp, 16*N)` and the sampling rate. Only the samples read by every
+        module are returned. The pressure is decoded into `out`, if given.
+        """
+        for m in self.modules:
+            if m.thread is not None:
+                m.thread.join()
+        for m in self.modules:
+            if m.thread is not None and m.thread.error is not None:
+                # The other modules would be cut to the frames of this one
+                error = m.thread.error
+                self.reset()
+                raise RuntimeError("Acquisition failed on {}: {}".format(m.ip, error)) from error
+        packs = [m.pack for m in self.modules]
+        nsamp = min(pk.samplesread for pk in packs)
+        if nsamp == 0:
+            raise RuntimeError("Nothing to read from scanivalve array!")
+        self.tstart = np.array([pk.time1 for pk in packs])
+        self.tfirst = np.array([pk.time2 for pk in packs])
+        freq = np.mean([1.0/pk.get_time(True) for pk in packs])
+        if out is not None:
+            if out.shape[0] < nsamp:
+                raise RuntimeError("Output array too small for {} frames!".format(nsamp))
+            p = out[:nsamp]
+        else:
+            p = np.empty((nsamp, 16*len(packs)), dtype)
+        for i, pk in enumerate(packs):
+            pk.decode(pk.frames()[:nsamp]['press'], p[:,16*i:16*(i+1)])
+        for m in self.modules:
+            m.pack.clear()
+            m.thread = None
+            m.acquiring = False
+        return p, freq
+
+    def acquire(self, dtype=np.float64, out=None):
+        self.start()
+        return self.read(dtype, out)
+
+    def starttimes(self):
+        "Time (`time.monotonic`) when each module was sent the SCAN command during the last acquisition"
+        return self.tstart
+    
+    def skew(self):
+        """
+        Measured inter-module skew in seconds of the last acquisition: the
+        spread of the times the SCAN command was sent to each module.
+        """
+        return self.tstart.max() - self.tstart.min()
+
+    def stop(self):
+        self.parallel(lambda m: m.stop())
+
+    def stats(self):
+        "`Scanivalve.stats` of every module"
+        return [m.stats() for m in self.modules]
+
+    def metrics_text(self, prefix='scanivalve'):
+        "`stats` of every module in the Prometheus text exposition format"
+        return prometheus_text([m.stats() for m in self.modules], prefix,
+                               [dict(ip=m.ip, module=i+1) for i, m in enumerate(self.modules)])
     
+    def close(self):
+        self.parallel(lambda m: m.close())
+        self.modules = []
+        
+    def nchans(self):
+        return 16*len(self.modules)
+
+    def channames(self):
+        return ["{}-{:02d}".format(i+1, k+1) for i in range(len(self.modules)) for k in range(16)]
+
+
+class AsyncScanivalve(object):
+    """
+    # asyncio data acquisition from DSA3217
+
+    Same operations as `Scanivalve` but every input/output operation is a
+    coroutine, so that many scanivalves can share one event loop without
+    one thread per device.
+
+    ```python
+    import asyncio
+    import scanivalve
+
+    async def main(ip):
+        s = scanivalve.AsyncScanivalve(ip)
+        await s.connect()
+        await s.config(FPS=1000)
+        async for p in s.scan():
+            print(p.mean(0))
+        await s.close()
+
+    asyncio.run(main(ip))
+    ```
+    """
+    def __init__(self, ip='191.30.80.131', tinfo=False, port=23):
+        self.s = None
+        self.ip = ip
+        self.port = port
+        self.acquiring = False
+        self.replylines = {}
+        self.devstate = {}
+        self.numchans = 16
+        
+        self.FPS = 1
+        self.PERIOD=500
+        self.AVG=16
+        self.XSCANTRIG = 0
+        self.ringsize = 65536
+        self.time = 2 if tinfo else 0
+        self.dt = self.PERIOD*1e-6*16 * self.AVG
+        
+        self.model = None
+        self.packet_info = None
+        self.pack = None
+        self.stopped = None
+        self.scanner = None
+
+    async def connect(self, timeout=5):
+        """
+        Connects to the scanivalve and configures it the same way `Scanivalve` does.
+        """
+        loop = asyncio.get_running_loop()
+        self.s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4*1024*1024)
+        self.s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.s.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(self.s, (self.ip, self.port)), timeout)
+        except (OSError, asyncio.TimeoutError):
+            self.s.close()
+            self.s = None
+            raise RuntimeError("Unable to connect to scanivalve on IP:{}!".format(self.ip))
+
+        await self.clear()
+        self.devstate = await self.list_any_map('S')
+        await self.set_vars([("BIN", 1), ("EU", 1), ("UNITSCAN", "PA"), ("XSCANTRIG", self.XSCANTRIG),
+                             ("QPKTS", 0), ("TIME", self.time), ("SIM", 0),
+                             ("AVG", self.AVG), ("PERIOD", self.PERIOD), ("FPS", self.FPS)])
+        
+        self.model = (await self.get_model()).strip()
+        self.packet_info = packet_layout(self.model, self.time > 0)
+        self.pack = Packet(self.packet_info)
+        self.pack.allocbuffer(self.FPS, self.ringsize)
+
+    def check_idle(self):
+        if self.acquiring:
+            raise RuntimeError("Illegal operation. Scanivalve is currently acquiring data!")
+        
+    async def send(self, cmd):
+        await asyncio.get_running_loop().sock_sendall(self.s, cmd)
+
+    async def recv_pending(self, timeout):
+        "Reads whatever the scanivalve sends until it is quiet for `timeout` seconds"
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        while True:
+            try:
+                chunk = await asyncio.wait_for(loop.sock_recv(self.s, 65536), timeout)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            buffer += chunk
+        return bytes(buffer)
+
+    async def read_reply(self, command=None, timeout=0.5, gap=0.02):
+        "Reads the reply to a command. See `Scanivalve.read_reply`"
+        loop = asyncio.get_running_loop()
+        buffer = bytearray()
+        nlines = self.replylines.get(command)
+        wait = timeout
+        while True:
+            try:
+                chunk = await asyncio.wait_for(loop.sock_recv(self.s, 4096), wait)
+            except asyncio.TimeoutError:
+                break
+            if not chunk:
+                break
+            buffer += chunk
+            status = reply_status(buffer, nlines)
+            if status == REPLY_DONE:
+                if select([self.s], [], [], 0)[0]:
+                    nlines = None
+                    wait = gap
+                    continue
+                break
+            wait = gap if status == REPLY_LINE else timeout
+        if command is not None and buffer:
+            self.replylines[command] = buffer.count(b'\r\n')
+        return bytes(buffer)
         
+    async def list_any(self, command, timeout=0.2):
+        "Sends the command `LIST command` and returns the reply split into lines of words"
+        self.check_idle()
+        cmd = ("LIST %s\n" % (command)).encode()
+        await self.send(cmd)
+        return parse_list(await self.read_reply(cmd, timeout))
+
+    async def list_any_map(self, command, timeout=0.5):
+        "Takes data obtained from `list_any` and builds a dictionary"
+        buffer = await self.list_any(command, timeout)
+        return {b[1]:b[2] for b in buffer if len(b) >= 3}
+
+    async def get_model(self):
+        "Returns the model of the scanivalve"
+        return (await self.list_any_map("I"))["MODEL"]
+
+    async def set_var(self, var, val):
+        "Sets a parameter in the scanivalve with the command `SET var val`"
+        self.check_idle()
+        await self.send(( "SET %s %s\n" % (var, val) ).encode())
+        self.devstate.pop(var.upper(), None)
+
+    async def set_vars(self, settings, verify=True):
+        "Sets several parameters in a single transaction. See `Scanivalve.set_vars`"
+        self.check_idle()
+        pending = pending_settings(settings, self.devstate)
+        if not pending:
+            return []
+        await self.send(''.join("SET %s %s\n" % (var, val) for var, val in pending).encode())
+        if verify:
+            self.devstate = await self.list_any_map('S')
+            check_settings(pending, self.devstate)
+        else:
+            self.devstate.update((var, str(val)) for var, val in pending)
+        return [var for var, val in pending]
+
+    async def hard_zero(self, wait=False, timeout=30.0, poll=0.1):
+        "Command to zero the DSA-3X17. See `Scanivalve.hard_zero`"
+        self.check_idle()
+        await self.send(b"CALZ\n")
+        if wait:
+            t1 = time.monotonic() + timeout
+            while await self.status() in ('CALZ', ''):
+                if time.monotonic() > t1:
+                    raise RuntimeError("Scanivalve zero (CALZ) did not finish in {} s!".format(timeout))
+                await asyncio.sleep(poll)
+
+    async def status(self):
+        "State of the scanivalve (STATUS command). See `Scanivalve.status`"
+        self.check_idle()
+        await self.send(b"STATUS\n")
+        buffer = await self.read_reply(b"STATUS\n")
+        return parse_list(buffer)[-1][-1].upper()
+
+    async def clear(self):
+        "Clear the error buffer in the scanivalve"
+        self.check_idle()
+        await self.send(b"CLEAR\n")
 
+    async def error(self):
+        "Returns the errors detected by the scanivalve"
+        self.check_idle()
+        await self.send(b"ERROR\n")
+        return await self.read_reply(timeout=1)
         
+    async def config(self, **kw):
+        """
+        Configures data aquisition. Device keywords and `RINGSIZE` as in
+        `Scanivalve.config`: its other options are not supported by the
+        asyncio client.
+        """
+        self.check_idle()
+        realloc = False
+        settings = []
+        for k in kw.keys():
+            K = k.upper()
+            if K=='RINGSIZE':
+                self.ringsize = max(1, int(kw[k]))
+                realloc = True
+                continue
+            val = config_value(self.model, K, kw[k])
+            setattr(self, K, val)
+            if K=='FPS':
+                realloc = True
+            settings.append((K, val))
+        await self.set_vars(settings)
+        self.pack.xtrig = bool(self.XSCANTRIG)
+
+        if realloc:
+            self.pack.allocbuffer(self.FPS, self.ringsize)
+        self.dt = self.PERIOD*1e-6*16 * self.AVG
+
+    async def list_config(self):
+        self.check_idle()
+        conf = dict(devtype='pressure', manufacturer='scanivalve', model=self.model,
+                    parameters=await self.list_any_map('S'))
+        return conf
+    
+    def scan(self, dtype=np.float64):
+        """
+        Starts a scan and iterates over blocks of pressure frames as they arrive.
+
+        With FPS=0 the scan goes on until `stop` is called. Leaving the
+        `async for` loop early is fine as long as `stop` is called next.
+        """
+        self.scanner = self.receive(dtype)
+        return self.scanner
+
+    async def receive(self, dtype):
+        "Asynchronous generator behind `scan`"
+        self.check_idle()
+        pack = self.pack
+        pack.clear()
+        timeout = max(0.5, 3 * self.dt)
+        self.stopped = asyncio.Event()
+        await self.send(b"SCAN\n")
+        pack.begin(self.dt)
+        self.acquiring = True
+        k = 0
+        try:
+            while not pack.stop_reading:
+                try:
+                    # Frames already pending are read without going through the event loop
+                    n = self.s.recv_into(pack.recv_view())
+                except BlockingIOError:
+                    wait = None if pack.xtrig and pack.nbytes == 0 else timeout
+                    n = await self.recv_or_stop(pack.recv_view(), wait)
+                    if n is None:
+                        break
+                if n == 0:
+                    raise ConnectionError("Scanivalve closed the connection!")
+                pack.advance(n)
+                if pack.samplesread > k:
+                    if pack.continuous:
+                        yield pack.drain(dtype=dtype)
+                    else:
+                        yield pack.frames()[k:]['press'].astype(dtype)
+                    k = pack.samplesread
+                if pack.finished():
+                    break
+            if pack.stop_reading:
+                # Frames sent before the scanivalve got the STOP command
+                await self.recv_pending(0.02)
+        finally:
+            pack.acquiring = False
+            self.acquiring = False
+
+    async def recv_or_stop(self, view, timeout):
+        """
+        Waits for data and receives it into `view`. Returns `None` as soon as
+        `stop` is called (the pending receive is cancelled).
+        """
+        loop = asyncio.get_running_loop()
+        recv = loop.create_task(loop.sock_recv_into(self.s, view))
+        stop = loop.create_task(self.stopped.wait())
+        done, pending = await asyncio.wait([recv, stop], timeout=timeout,
+                                           return_when=asyncio.FIRST_COMPLETED)
+        for task in pending:
+            task.cancel()
+        if recv in done:
+            return recv.result()
+        if stop in done:
+            return None
+        raise socket.timeout("timed out")
+
+    async def acquire(self, dtype=np.float64, copy=True, temp=False, tdecim=1, out=None):
+        "Reads FPS frames and returns the pressure and the sampling rate (and temperature)"
+        if self.pack.continuous:
+            raise RuntimeError("acquire needs a finite number of frames (FPS > 0)!")
+        async for p in self.scan():
+            pass
+        data = self.pack.read(dtype=dtype, copy=copy, temp=temp, tdecim=tdecim, out=out)
+        self.pack.clear()
+        return data
+
+    async def stop(self):
+        """
+        Stops the scanivalve. If `scan` is running, it reads the frames
+        still arriving, otherwise they are discarded here.
+        """
+        if self.pack is not None:
+            self.pack.stop_reading = True
+        if self.stopped is not None:
+            # Wakes up `scan` right away
+            self.stopped.set()
+        await self.send(b"STOP\n")
+        if self.acquiring and self.scanner is not None and not self.scanner.ag_running:
+            # The `async for` over `scan` was left: the generator is suspended
+            await self.scanner.aclose()
+        if not self.acquiring:
+            await self.recv_pending(0.02)
+
+    async def close(self):
+        if self.acquiring:
+            await self.stop()
+        self.s.close()
+        self.s = None
+        if self.pack is not None:
+            self.pack.close()
+
+    def nchans(self):
+        return 16
+
+    def channames(self):
+        return ["{:02d}".format(i+1) for i in range(self.nchans())]
@@ -6,7 +6,7 @@ with open("README.md", "r") as fh:
 
 setuptools.setup(
     name="scanivalve",
-    py_modules=['scanivalve','scanigui'],
+    py_modules=['scanivalve','scanigui','scanifile','scaniproc','scanishm','scanisim','scanibench'],
     version="0.1",
     author = "Paulo Jabardo",
     author_email = "pjabardo@gmail.com",
@@ -17,7 +17,7 @@ setuptools.setup(
     classifiers = ["Programming Language :: Python :: 3",
                    "License :: OSI Approved :: MIT License",
                    "Operating System :: OS Independent"],
-    python_requires='>=3.4')
+    python_requires='>=3.8')
 
     
     
@@ -0,0 +1,61 @@
+"""
+Tests of the capture file format (`scanifile`).
+"""
+import numpy as np
+import pytest
+
+import scanivalve
+import scanifile
+
+
+def raw_frames(k0, n, tinfo=False):
+    "Raw frames (shape `(n, packlen)`): every pressure channel is the frame index"
+    fr = np.zeros(n, scanivalve.frame_dtype(tinfo))
+    fr['ptype'] = 10
+    fr['size'] = fr.dtype.itemsize
+    fr['press'] = np.arange(k0, k0 + n)[:, None]
+    fr['press'] += np.arange(16) / 100
+    return fr.view(np.uint8).reshape(n, fr.dtype.itemsize)
+
+
+def write_capture(filename, sizes, close=True):
+    info = dict(model='3217', packlen=104, t=False, dt=0.001)
+    w = scanifile.CaptureWriter(filename, info)
+    k = 0
+    for n in sizes:
+        w.write(raw_frames(k, n))
+        k += n
+    if close:
+        w.close()
+    else:
+        w.flush()
+    return w
+
+
+@pytest.mark.parametrize('close', [True, False])
+def test_round_trip(tmp_path, close):
+    # user-009: frames read back across chunks, with or without the block index
+    filename = str(tmp_path / 'run.scap')
+    w = write_capture(filename, [100, 0, 250, 1, 649], close)
+    try:
+        with scanifile.CaptureReader(filename) as f:
+            assert len(f) == 1000
+            assert len(f.index) == 4
+            assert f.info['model'] == '3217'
+            p = f.read()
+            assert p.shape == (1000, 16)
+            np.testing.assert_array_equal(p[:, 0], np.arange(1000))
+            p = f.read(90, 360, chans=[0, 5])
+            np.testing.assert_allclose(p, np.arange(90, 360)[:, None] + [0, 0.05], atol=1e-4)
+            np.testing.assert_array_equal(f.read_time(0.5, 0.6)[:, 0], np.arange(500, 600))
+            assert len(f.read(990, 2000)) == 10
+            assert len(f.read(500, 500)) == 0
+    finally:
+        w.close()
+
+
+def test_incomplete_frame(tmp_path):
+    # user-009: only whole frames are written
+    with scanifile.CaptureWriter(str(tmp_path / 'run.scap'), dict(model='3217', packlen=104, t=False)) as w:
+        with pytest.raises(RuntimeError):
+            w.write(raw_frames(0, 2).tobytes()[:150])
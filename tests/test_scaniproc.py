@@ -0,0 +1,64 @@
+"""
+Tests of the parallel post-processing (`scaniproc`).
+"""
+import numpy as np
+import pytest
+
+import scanivalve
+import scaniproc
+
+
+def frames(x):
+    "Structured frames with the pressure `x` (shape `(nframes, 16)`)"
+    fr = np.zeros(len(x), scanivalve.frame_dtype(False))
+    fr['ptype'] = 10
+    fr['size'] = fr.dtype.itemsize
+    fr['press'] = x
+    return fr
+
+
+@pytest.fixture(scope='module')
+def pp():
+    with scaniproc.PostProcessor(nworkers=2, nperseg=256, chanblock=5, segframes=1000) as pp:
+        yield pp
+
+
+def test_stats(pp):
+    # user-015: statistics merged from every task
+    rng = np.random.default_rng(2)
+    x = rng.normal(100.0, 3.0, (10000, 16)).astype(np.float32)
+    stats, f, psd = pp.submit_frames(frames(x), 1000.0, False).result()
+    y = x.astype(np.float64)
+    assert stats.n == 10000
+    np.testing.assert_allclose(stats.mean, y.mean(0))
+    np.testing.assert_allclose(stats.std(), y.std(0, ddof=1))
+    np.testing.assert_array_equal(stats.min, y.min(0))
+    np.testing.assert_array_equal(stats.max, y.max(0))
+
+
+def test_psd(pp):
+    # user-015: Welch PSD of a sine (peak and total power) and of white noise
+    rate = 1000.0
+    t = np.arange(20000) / rate
+    x = np.empty((20000, 16))
+    x[:] = (np.sqrt(2) * np.sin(2 * np.pi * 125.0 * t))[:, None]
+    x[:, 8:] = np.random.default_rng(3).normal(0.0, 1.0, (20000, 8))
+    raw = frames(x).view(np.uint8).reshape(20000, -1)
+    stats, f, psd = pp.submit_frames(raw, rate, False).result()
+    assert psd.shape == (129, 16)
+    assert f[np.argmax(psd[:, 0])] == pytest.approx(125.0)
+    df = f[1] - f[0]
+    np.testing.assert_allclose(psd[:, :8].sum(0) * df, 1.0, rtol=0.02)
+    # White noise: flat at 2/rate
+    np.testing.assert_allclose(psd[1:-1, 8:].mean(0), 2 / rate, rtol=0.05)
+
+
+def test_calibration(pp):
+    # user-022: the workers apply the calibration before the statistics
+    rng = np.random.default_rng(4)
+    x = rng.normal(100.0, 3.0, (10000, 16))
+    cal = scanivalve.Calibration(np.full(16, 100.0), 1 + 0.1 * np.arange(16))
+    stats, f, psd = pp.submit_frames(frames(x), 1000.0, False, cal).result()
+    y = (x.astype(np.float32) - 100.0) * cal.gain
+    np.testing.assert_allclose(stats.mean, y.mean(0), atol=1e-6)
+    np.testing.assert_allclose(stats.std(), y.std(0, ddof=1), rtol=1e-5)
@@ -0,0 +1,349 @@
+"""
+Acquisition tests against the simulated DSA (`scanisim`) over the loopback
+interface, with fault injection.
+"""
+import asyncio
+import time
+
+import numpy as np
+import pytest
+
+import scanifile
+import scanivalve
+import scanisim
+
+
+def connect(sim, tinfo=False, **kw):
+    s = scanivalve.Scanivalve('127.0.0.1', tinfo, sim.port)
+    s.config(PERIOD=160, AVG=1, **kw)
+    return s
+
+
+@pytest.fixture
+def scani(request):
+    "Scanivalve connected to a simulator built with the parameters of the test (`sim` marker)"
+    marker = request.node.get_closest_marker('sim')
+    opts = dict(rate=0, signal=scanisim.counter_signal)
+    if marker is not None:
+        opts.update(marker.kwargs)
+    sim = scanisim.Simulator('3217', **opts)
+    s = connect(sim)
+    s.sim = sim
+    yield s
+    s.close()
+    sim.close()
+
+
+def check_counter(p, k0=0):
+    "Every channel is the frame index: frames `k0`, `k0+1`, ..."
+    assert np.all(p == p[:, :1])
+    np.testing.assert_array_equal(p[:, 0], np.arange(k0, k0 + len(p)))
+
+
+@pytest.mark.sim(fragment=37)
+def test_fragmented_frames(scani):
+    # user-003: frames split across recv calls are reassembled
+    scani.pack.chunksize = 4096
+    scani.config(FPS=5000)
+    p, freq = scani.acquire()
+    assert p.shape == (5000, 16)
+    check_counter(p)
+
+
+def test_chunked_tinfo():
+    # user-003: 112 byte frames do not divide the chunk size
+    with scanisim.Simulator('3217', rate=0, signal=scanisim.counter_signal) as sim:
+        s = connect(sim, tinfo=True, FPS=3000)
+        try:
+            s.pack.chunksize = 1000
+            s.start()
+            p, freq, t = s.read(times=True)
+            check_counter(p)
+            assert len(t) == 3000
+        finally:
+            s.close()
+
+
+@pytest.mark.sim(rate=20000)
+def test_continuous_drain(scani):
+    # user-002: continuous scan drained while it goes on, no frame lost or repeated
+    scani.config(FPS=0, RINGSIZE=65536)
+    scani.start()
+    blocks = []
+    t1 = time.monotonic() + 0.5
+    while time.monotonic() < t1:
+        time.sleep(0.05)
+        blocks.append(scani.read()[0])
+    assert scani.overflow() == 0
+    scani.stop()
+    if scani.pack.samplesread > scani.pack.nread:
+        blocks.append(scani.read()[0])
+    p = np.concatenate(blocks)
+    assert len(p) > 1000
+    check_counter(p)
+
+
+@pytest.mark.sim(rate=20000)
+def test_ring_overflow(scani):
+    # user-002: frames that do not fit in the ring are dropped and counted
+    scani.config(FPS=0, RINGSIZE=1024)
+    scani.start()
+    time.sleep(0.3)
+    p, freq = scani.read()
+    assert scani.overflow() > 0
+    scani.stop()
+    assert len(p) == 1024
+    check_counter(p)
+
+
+@pytest.mark.sim(rate=20000)
+def test_acquire_after_continuous(scani):
+    # user-002: a stopped continuous scan leaves nothing behind
+    scani.config(FPS=0)
+    scani.start()
+    time.sleep(0.1)
+    scani.read()
+    scani.stop()
+    scani.config(FPS=1000)
+    p, freq = scani.acquire()
+    check_counter(p)
+    assert scani.list_any_map('S')['FPS'] == '1000'
+
+
+@pytest.mark.parametrize('prompt', [False, True])
+def test_reply_framing(prompt):
+    # user-006: replies end when the last line arrives, not on a timeout
+    with scanisim.Simulator('3217', prompt=prompt) as sim:
+        s = connect(sim)
+        try:
+            t0 = time.perf_counter()
+            for i in range(10):
+                conf = s.list_any_map('S')
+            dt = (time.perf_counter() - t0) / 10
+            assert conf['PERIOD'] == '160'
+            assert dt < 0.1
+            assert b'NO ERRORS' in s.error()
+        finally:
+            s.close()
+
+
+@pytest.mark.sim(rate=50000, disconnect_after=5000)
+def test_resume(scani):
+    # user-020: the connection is lost and the scan resumes on a new one
+    scani.config(FPS=20000, RESUME=True)
+    scani.backoff = 0.05
+    scani.start()
+    p, freq = scani.read()
+    assert p.shape == (20000, 16)
+    gaps = scani.gaps()
+    assert len(gaps) == 1
+    k, nmiss, tgap = gaps[0]
+    check_counter(p[:k])
+
+
+@pytest.mark.sim(disconnect_after=5000)
+def test_no_resume(scani):
+    # user-020: without RESUME the frames received so far are returned
+    scani.config(FPS=20000)
+    scani.start()
+    p, freq = scani.read()
+    assert 0 < len(p) <= 5000
+    check_counter(p)
+
+
+@pytest.mark.sim(disconnect_after=5000)
+def test_continuous_error(scani):
+    # user-020: continuous read returns the frames received before the failure, then raises
+    scani.config(FPS=0)
+    scani.start()
+    time.sleep(0.3)
+    frames = []
+    t1 = time.monotonic() + 5
+    with pytest.raises(RuntimeError, match='Acquisition failed'):
+        while time.monotonic() < t1:
+            frames.append(scani.read()[0])
+            time.sleep(0.01)
+    p = np.concatenate(frames)
+    assert 0 < len(p) <= 5000
+    check_counter(p)
+    assert not scani.acquiring
+
+
+
+@pytest.mark.sim(rate=None)
+def test_stop_latency(scani):
+    # user-021: stop does not wait for the next frame (about 2 s apart)
+    scani.config(FPS=0, PERIOD=65000, AVG=2)
+    scani.start()
+    time.sleep(0.2)
+    t0 = time.perf_counter()
+    scani.stop()
+    assert time.perf_counter() - t0 < 0.5
+    assert not scani.thread
+
+
+def test_async_stop_latency():
+    # user-021: same with the asyncio client
+    async def run(port):
+        s = scanivalve.AsyncScanivalve('127.0.0.1', port=port)
+        await s.connect()
+        try:
+            await s.config(FPS=0, PERIOD=65000, AVG=2)
+            async def reader():
+                async for p in s.scan():
+                    pass
+            task = asyncio.ensure_future(reader())
+            await asyncio.sleep(0.2)
+            t0 = time.perf_counter()
+            await s.stop()
+            await task
+            return time.perf_counter() - t0
+        finally:
+            await s.close()
+    with scanisim.Simulator('3217') as sim:
+        assert asyncio.run(run(sim.port)) < 0.5
+
+
+
+def test_array_trigger():
+    # user-005: the modules wait for the external trigger, longer than the receive timeout
+    sims = [scanisim.Simulator('3217', rate=0, signal=scanisim.counter_signal) for i in range(2)]
+    try:
+        a = scanivalve.ScanivalveArray([('127.0.0.1', sim.port) for sim in sims])
+        try:
+            a.config(FPS=1000, PERIOD=160, AVG=1, XSCANTRIG=1)
+            a.start()
+            time.sleep(1.0)
+            for sim in sims:
+                sim.trigger()
+            p, freq = a.read()
+            assert p.shape == (1000, 32)
+            check_counter(p[:, :16])
+            check_counter(p[:, 16:])
+        finally:
+            a.close()
+    finally:
+        for sim in sims:
+            sim.close()
+
+
+def test_metrics():
+    # user-019: counters of every module, one metric family per array
+    sims = [scanisim.Simulator('3217', rate=0, signal=scanisim.counter_signal) for i in range(2)]
+    try:
+        a = scanivalve.ScanivalveArray([('127.0.0.1', sim.port) for sim in sims])
+        try:
+            a.config(FPS=1000, PERIOD=160, AVG=1)
+            a.acquire()
+            for st in a.stats():
+                assert st['scans'] == 1
+                assert st['scans_stopped'] == 0
+                assert st['frames_received'] == 1000
+                assert st['commands']
+            text = a.metrics_text()
+        finally:
+            a.close()
+    finally:
+        for sim in sims:
+            sim.close()
+    lines = text.splitlines()
+    types = [l for l in lines if l.startswith('# TYPE')]
+    assert len(types) == len(set(types))
+    assert 'scanivalve_frames_received{ip="127.0.0.1",module="1"} 1000' in lines
+    assert 'scanivalve_frames_received{ip="127.0.0.1",module="2"} 1000' in lines
+
+
+@pytest.mark.sim(rate=20000)
+def test_record_capture(scani, tmp_path):
+    # user-009: continuous acquisition streamed into a capture file and read back
+    filename = str(tmp_path / 'run.scap')
+    scani.config(FPS=0)
+    n = scanifile.record_capture(filename, scani, 0.3, interval=0.05)
+    assert n > 1000
+    with scanifile.CaptureReader(filename) as f:
+        assert len(f) == n
+        assert f.info['FPS'] == 0
+        check_counter(f.read())
+        check_counter(f.read(n // 2, n // 2 + 100), n // 2)
+
+
+def test_zero_offsets(scani, tmp_path):
+    # user-022: the zero frames do not touch the configured buffer (here a MEMMAP file)
+    filename = str(tmp_path / 'cal.json')
+    scani.config(FPS=1000, MEMMAP=str(tmp_path / 'frames.bin'))
+    buf = scani.pack.buf
+    cal = scani.zero_offsets(64, filename=filename)
+    np.testing.assert_allclose(cal.offset, 31.5)
+    assert scani.pack.buf is buf
+    assert scani.list_any_map('S')['FPS'] == '1000'
+    p, freq = scani.acquire()
+    np.testing.assert_allclose(p, np.arange(1000)[:, None] - 31.5 + np.zeros(16))
+    assert scanivalve.load_calibration(scani.serial(), filename) is not None
+
+
+
+@pytest.mark.sim(garbage_every=997, fragment=300)
+def test_resync(scani):
+    # user-023: garbage between frames is discarded and recorded
+    scani.config(FPS=20000)
+    p, freq = scani.acquire()
+    check_counter(p)
+    assert len(scani.resyncs()) == 20000 // 997
+    st = scani.stats()
+    assert st['resyncs'] == 20000 // 997
+    assert st['bytes_discarded'] == scani.sim.garbage
+    assert st['frames_received'] == 20000
+
+
+def test_misaligned_start():
+    # user-023: the header is found even if the first bytes are not a frame
+    sim = scanisim.Simulator('3217', signal=scanisim.counter_signal)
+    try:
+        pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+        pk.allocbuffer(100)
+        data = bytes(range(1, 51)) + sim.frames(0, 120, 0.001)
+        i = 0
+        while not pk.finished():
+            v = pk.recv_view()
+            n = min(len(v), 37, len(data) - i)
+            v[:n] = data[i:i+n]
+            pk.advance(n)
+            i += n
+        check_counter(pk.frames()['press'])
+        assert pk.resyncs == [(0, 0, 50)]
+    finally:
+        sim.close()
+
+
+def test_acquire_out(scani):
+    # user-024: back to back acquisitions into the same array
+    scani.config(FPS=1000)
+    out = np.empty((1000, 16))
+    for i in range(3):
+        p, freq = scani.acquire(out=out)
+        assert np.shares_memory(p, out)
+        check_counter(p)
+
+
+@pytest.mark.sim(rate=20000)
+def test_pipeline(scani):
+    # user-025: back to back points, each one a complete acquisition
+    scani.config(FPS=2000)
+    n = 0
+    with scani.pipeline(nbuf=2) as q:
+        for p, freq in q.acquire(5):
+            assert p.shape == (2000, 16)
+            check_counter(p)
+            n += 1
+    assert n == 5
+    assert not scani.acquiring
+    p, freq = scani.acquire()
+    check_counter(p)
+
+
+def test_pipeline_stages(scani):
+    # user-025: stage output would be lost from one point to the next
+    scani.config(FPS=1000)
+    scani.pack.add_stage(scanivalve.BlockMean(10))
+    with pytest.raises(RuntimeError, match='stages'):
+        scani.pipeline()
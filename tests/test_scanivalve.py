@@ -0,0 +1,247 @@
+"""
+Tests of the parts of `scanivalve` that do not need a device.
+"""
+import numpy as np
+import pytest
+
+import scanivalve
+
+
+def test_pending_settings():
+    # user-007: only the settings that differ from the device are sent
+    devstate = {'FPS': '1000', 'AVG': '16', 'PERIOD': '500', 'UNITSCAN': 'PA'}
+    pending = scanivalve.pending_settings([('fps', 1000), ('AVG', 32), ('PERIOD', '500.0'),
+                                           ('UNITSCAN', 'pa'), ('SIM', 0)], devstate)
+    assert pending == [('AVG', 32), ('SIM', 0)]
+    assert scanivalve.pending_settings(dict(FPS=1000), devstate) == []
+
+
+def test_check_settings():
+    # user-007: settings not accepted by the device are reported
+    scanivalve.check_settings([('AVG', 32), ('SIM', 0)], {'AVG': '32'})
+    with pytest.raises(RuntimeError, match='AVG=240'):
+        scanivalve.check_settings([('AVG', 240)], {'AVG': '16'})
+
+
+def make_frames(n, tinfo=False, k0=0):
+    "Binary EU frames as sent by the device: every pressure channel is the frame index"
+    fr = np.zeros(n, scanivalve.frame_dtype(tinfo))
+    fr['ptype'] = 10
+    fr['size'] = fr.dtype.itemsize
+    fr['press'] = np.arange(k0, k0 + n)[:, None]
+    fr['temp'] = 25.0
+    return fr
+
+
+def feed(pk, data, chunk=1000):
+    "Hands the bytes `data` to the packet in pieces of `chunk` bytes, as the receive loop does"
+    data = memoryview(data).cast('B')
+    i = 0
+    while i < len(data):
+        v = pk.recv_view()
+        n = min(len(v), chunk, len(data) - i)
+        v[:n] = data[i:i+n]
+        pk.advance(n)
+        i += n
+
+
+def test_memmap(tmp_path):
+    # user-008: frames go to the file and are read back with load_frames
+    filename = str(tmp_path / 'frames.bin')
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(1000, filename=filename)
+    pk.releasesize = 4096
+    feed(pk, make_frames(600))
+    frames = scanivalve.load_frames(filename)
+    # Frames not received yet are left out
+    assert len(frames) == 600
+    np.testing.assert_array_equal(frames['press'][:, 0], np.arange(600))
+    del frames
+    pk.close()
+    with pytest.raises(RuntimeError):
+        pk.allocbuffer(0, filename=filename)
+
+
+def test_timing_stats():
+    # user-011: dropped frames and jitter from the frame timestamps
+    dt = 0.001
+    t = np.arange(1000) * dt
+    t[500:] += dt           # One frame missing
+    t[100] += 0.1 * dt      # Late frame
+    st = scanivalve.timing_stats(t)
+    assert st['nframes'] == 1000
+    assert st['dt'] == pytest.approx(dt)
+    assert st['dropped'] == 1
+    assert st['duplicated'] == 0
+    assert st['jitter_max'] == pytest.approx(0.1 * dt)
+    assert st['maxgap'] == pytest.approx(2 * dt)
+    with pytest.raises(RuntimeError):
+        scanivalve.timing_stats(t[:1])
+
+
+@pytest.mark.parametrize('tunit', [0, 1])
+def test_timestamps(tunit):
+    # user-011: device time in ms or μs, unwrapped past the 32 bit counter
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', True))
+    pk.allocbuffer(1000)
+    fr = make_frames(1000, tinfo=True)
+    mult = 1e6 if tunit == 1 else 1e3
+    ticks = 2**31 - 500 + np.arange(1000) * 2
+    fr['time'] = (ticks + 2**31) % 2**32 - 2**31
+    fr['tunit'] = tunit
+    feed(pk, fr)
+    t = pk.get_timestamps()
+    np.testing.assert_allclose(t, np.arange(1000) * 2 / mult)
+    p, freq, t = pk.read(meas=False, times=True)
+    assert freq == pytest.approx(mult / 2)
+    np.testing.assert_array_equal(p[:, 0], np.arange(1000))
+
+
+def test_peek():
+    # user-012: frames received so far, without consuming them
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(1000)
+    feed(pk, make_frames(300))
+    p, k = pk.peek(0, np.float32, copy=False)
+    assert k == 300
+    np.testing.assert_array_equal(p[:, 0], np.arange(300))
+    feed(pk, make_frames(200, k0=300))
+    p, k = pk.peek(k)
+    assert k == 500
+    np.testing.assert_array_equal(p[:, 0], np.arange(300, 500))
+
+
+def test_peek_ring():
+    # user-012: in a ring, frames within reach of the next recv are left out
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(0, ringsize=100)
+    pk.chunksize = 10 * pk.packlen
+    feed(pk, make_frames(90))
+    pk.drain()
+    feed(pk, make_frames(60, k0=90))
+    p, k = pk.peek(0)
+    assert k == 150
+    # Frames 50 to 59 share the ring slots with the next 10 frames
+    np.testing.assert_array_equal(p[:, 0], np.arange(60, 150))
+
+
+def test_channel_stats():
+    # user-013: blocks merged with the same result as the whole data
+    rng = np.random.default_rng(0)
+    x = rng.normal(1000.0, 2.0, (5000, 16))
+    st = scanivalve.ChannelStats(16)
+    for i in range(0, 5000, 777):
+        st.update(x[i:i+777])
+    other = scanivalve.ChannelStats(16)
+    other.update(x[:1000])
+    st.merge(other)
+    y = np.concatenate([x, x[:1000]])
+    assert st.n == 6000
+    np.testing.assert_allclose(st.mean, y.mean(0))
+    np.testing.assert_allclose(st.std(), y.std(0, ddof=1))
+    np.testing.assert_allclose(st.rms(), np.sqrt((y**2).mean(0)))
+    np.testing.assert_array_equal(st.min, y.min(0))
+    np.testing.assert_array_equal(st.max, y.max(0))
+
+
+def test_stats_only():
+    # user-013: statistics of every frame with a buffer smaller than the acquisition
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.statsframes = 100
+    pk.allocbuffer(5000, statsonly=True)
+    assert pk.buf.shape[0] == 100
+    feed(pk, make_frames(5000), chunk=777)
+    st = pk.chanstats
+    assert st.n == 5000
+    np.testing.assert_allclose(st.mean, 2499.5)
+    np.testing.assert_allclose(st.min, 0)
+    np.testing.assert_allclose(st.max, 4999)
+
+
+@pytest.mark.parametrize('block', [1, 7, 100, 1000])
+def test_decimation_stages(block):
+    # user-014: the output does not depend on how the frames are split into blocks
+    rng = np.random.default_rng(1)
+    x = rng.normal(0.0, 1.0, (3000, 16))
+    taps = rng.normal(0.0, 1.0, 9)
+    stages = [scanivalve.BlockMean(10), scanivalve.Downsample(10),
+              scanivalve.FIRDecimator(10, taps), scanivalve.CICDecimator(10, 2)]
+    for i in range(0, len(x), block):
+        for st in stages:
+            st.push(x[i:i+block])
+    mean, down, fir, cic = [st.read() for st in stages]
+    np.testing.assert_allclose(mean, x.reshape(300, 10, 16).mean(1))
+    np.testing.assert_array_equal(down, x[::10])
+    full = np.stack([np.convolve(x[:, c], taps, 'valid') for c in range(16)], 1)
+    np.testing.assert_allclose(fir, full[::10])
+    box = np.convolve(np.ones(10), np.ones(10)) / 100
+    full = np.stack([np.convolve(x[:, c], box, 'valid') for c in range(16)], 1)
+    np.testing.assert_allclose(cic, full[::10])
+    assert len(stages[0].read()) == 0
+
+
+def test_packet_stage():
+    # user-014: stages run on the frames as they are received
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(1000)
+    stage = pk.add_stage(scanivalve.BlockMean(100))
+    feed(pk, make_frames(1000), chunk=333)
+    np.testing.assert_allclose(stage.read()[:, 0], np.arange(10) * 100 + 49.5)
+
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32])
+def test_calibration(dtype):
+    # user-022: gain and offset (or polynomial) applied while the frames are decoded
+    offset = np.arange(16) * 0.5
+    gain = 1 + 0.1 * np.arange(16)
+    k = np.arange(1000)[:, None]
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(1000)
+    pk.cal = scanivalve.Calibration(offset, gain)
+    pk.cal.block = 300
+    feed(pk, make_frames(1000))
+    p = pk.get_pressure(dtype)
+    assert p.dtype == dtype
+    np.testing.assert_allclose(p, gain * (k - offset), rtol=1e-6)
+    poly = np.array([[0.001] * 16, [2.0] * 16, [-1.0] * 16])
+    pk.cal = scanivalve.Calibration(offset, poly=poly)
+    u = k - offset
+    np.testing.assert_allclose(pk.get_pressure(dtype), 0.001 * u**2 + 2 * u - 1, rtol=1e-6, atol=1e-4)
+
+
+def test_calibration_file(tmp_path):
+    # user-022: calibrations are saved keyed by serial number
+    filename = str(tmp_path / 'cal.json')
+    cal = scanivalve.Calibration(np.ones(16), np.full(16, 2.0), serial='1234')
+    scanivalve.save_calibration(cal, filename)
+    other = scanivalve.load_calibration('1234', filename)
+    np.testing.assert_array_equal(other.offset, cal.offset)
+    np.testing.assert_array_equal(other.gain, cal.gain)
+    assert other.serial == '1234'
+    assert scanivalve.load_calibration('4321', filename) is None
+
+
+def test_buffer_pool():
+    # user-024: smaller acquisitions reuse the largest buffer allocated so far
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(1000)
+    pool = pk.pool
+    pk.allocbuffer(300)
+    assert pk.pool is pool
+    assert np.shares_memory(pk.buf, pool)
+    feed(pk, make_frames(300))
+    np.testing.assert_array_equal(pk.get_pressure()[:, 0], np.arange(300))
+    pk.free_pool()
+    assert pk.pool.shape[0] == 300
+
+
+def test_read_out():
+    # user-024: the pressure is decoded into the array given by the caller
+    pk = scanivalve.Packet(scanivalve.packet_layout('3217', False))
+    pk.allocbuffer(500)
+    feed(pk, make_frames(500))
+    out = np.zeros((1000, 16), np.float32)
+    p, freq = pk.read(dtype=np.float32, out=out)
+    assert np.shares_memory(p, out)
+    assert p.shape == (500, 16)
+    np.testing.assert_array_equal(out[:500, 0], np.arange(500))